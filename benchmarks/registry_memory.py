@@ -0,0 +1,71 @@
+"""
+Memory benchmark for the in-memory service registry.
+
+Compares the full BSON-derived dicts the primary used to keep for every
+service against the projected, interned ServiceRecords built by
+db_functions.iter_microservices. No MongoDB is needed; documents are
+generated in the shape find() returns them.
+
+    python benchmarks/registry_memory.py --services 100000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+from bson import ObjectId
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from db_functions import SERVICE_FIELDS, make_service_record
+
+# Build documents the way pymongo hands them back: fresh strings per document,
+# even when the same address appears on thousands of services
+def generate_documents(count, recipients_per_service, teams):
+    for i in range(count):
+        team = i % teams
+        yield {
+            "_id": ObjectId(),
+            "name": f"service-{i}",
+            "url": f"http://service-{i}.internal:8080/status",
+            "recipients": [f"oncall-{team}-{r}@example.com" for r in range(recipients_per_service)],
+            "prev_status": True,
+            "probe_type": "http_get",
+        }
+
+def load_dicts(docs):
+    return list(docs)
+
+def load_records(docs):
+    recipient_lists = {}
+    projected = ({k: doc[k] for k in SERVICE_FIELDS if k in doc} for doc in docs)
+    return [make_service_record(doc, recipient_lists) for doc in projected]
+
+def measure(loader, count, recipients_per_service, teams):
+    tracemalloc.start()
+    started = time.perf_counter()
+    registry = loader(generate_documents(count, recipients_per_service, teams))
+    elapsed = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del registry
+    return current, peak, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--services", type=int, default=100000)
+    parser.add_argument("--recipients", type=int, default=3, help="recipients per service")
+    parser.add_argument("--teams", type=int, default=50, help="distinct recipient lists in the fleet")
+    args = parser.parse_args()
+
+    print(f"{args.services} services, {args.recipients} recipients each, {args.teams} teams")
+    print(f"{'representation':<16}{'retained MiB':>14}{'peak MiB':>12}{'load s':>10}")
+    results = {}
+    for label, loader in (("dict", load_dicts), ("ServiceRecord", load_records)):
+        current, peak, elapsed = measure(loader, args.services, args.recipients, args.teams)
+        results[label] = current
+        print(f"{label:<16}{current / 2**20:>14.1f}{peak / 2**20:>12.1f}{elapsed:>10.2f}")
+    print(f"ServiceRecord retains {results['ServiceRecord'] / results['dict']:.0%} of the dict registry")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# The alerting state machine shared by the primary watchdog and the replay simulator.
+# Nothing here talks to the network, Mongo or SMTP; the caller passes those in.
+
+def alert_message(service_name, alert_type):
+    subject = f"ALERT: {service_name} is {alert_type}!"
+    body = f"The microservice {service_name} is {alert_type}. Please check the service."
+    return subject, body
+
+# Message for everyone downstream of a service that changed state, so dependents don't
+# each alert on their own. Returns (subject, body, recipients), or None if nobody is affected.
+def root_cause_message(graph, service, alert_type):
+    affected = graph.descendants(service['name'])
+    if not affected:
+        return None
+    recipients = graph.subtree_recipients(service['name'])
+    if not recipients:
+        return None
+    if alert_type == "down":
+        subject = f"ALERT: {service['name']} is down, affecting {len(affected)} dependent services!"
+        body = (f"The microservice {service['name']} is down. These services depend on it and "
+                f"will not alert separately until it recovers: {', '.join(affected)}.")
+    else:
+        subject = f"ALERT: {service['name']} is up, re-checking {len(affected)} dependent services!"
+        body = (f"The microservice {service['name']} is up again. These dependent services are being "
+                f"re-checked now: {', '.join(affected)}.")
+    return subject, body, recipients
+
+# "down" or "up" when a result moves a service away from prev_status, otherwise None
+def transition(prev_status, healthy):
+    if prev_status == True and not healthy:
+        return "down"
+    if prev_status == False and healthy:
+        return "up"
+    return None
+
+# Apply a probe outcome to a service, whichever probe type produced it.
+# Alerts go out on transitions only and prev_status is only persisted when it changes.
+# The new status is persisted before alerting, so a registry reload in between can't
+# pick up the old status and alert a second time. Returns the status the service had
+# before, so a caller holding a lock around this call learns the transition exactly once.
+def apply_probe_result(service, healthy, reason, send_alert, persist_status, logger):
+    prev_status = service.get('prev_status')
+    if prev_status != healthy:
+        persist_status(service['name'], healthy)
+        service['prev_status'] = healthy
+
+    if healthy:
+        if prev_status == False:
+            logger.info(f"{service['name']} is back up.")
+            send_alert(service['name'], service['recipients'], alert_type="up")
+        logger.info(f"{service['name']} is healthy.")
+    else:
+        if prev_status == True:
+            logger.error(f"{service['name']} {reason}")
+            send_alert(service['name'], service['recipients'], alert_type="down")
+        logger.info(f"{service['name']} is down.")
+    return prev_status
+
+# Probe the given services, dependencies first.
+#   check(service)                 probes one service and records the result, alerts included
+#   check_batch(services)          probes and records several cheap (non GET) services at once
+#   probe_suppressed(services, blockers)  throttled probe of dependents of a down service
+#   is_batched(service)            whether a service goes through check_batch
+# Dependents of a down service are only probed every `suppress_every` sweeps, counted in
+# `suppressed_sweeps`, and when a service recovers its whole subtree is re-probed in the same pass.
+def sweep_services(services, graph, suppressed_sweeps, suppress_every, check, check_batch,
+                   probe_suppressed, is_batched, heartbeat=None):
+    levels = graph.group_by_level(services)
+    queued = {service['name'] for service in services}
+
+    # prev_status is read before the probe, so someone else may have recorded the same
+    # recovery meanwhile. That is fine here: it only decides what to re-probe, the
+    # alerts were decided by whoever recorded the result.
+    def requeue_if_recovered(service, prev_status):
+        if transition(prev_status, service.get('prev_status')) == "up":
+            for name in graph.descendants(service['name']):
+                if name not in queued:
+                    queued.add(name)
+                    levels.setdefault(graph.depth.get(name, 0), []).append(graph.services[name])
+
+    depth = 0
+    while depth <= max(levels, default=-1):
+        batched = []
+        throttled = []
+        blockers = {}
+        for service in levels.get(depth, ()):
+            if heartbeat:
+                heartbeat()
+            down_upstream = graph.down_ancestors(service['name'])
+            if down_upstream:
+                count = suppressed_sweeps.get(service['name'], 0) + 1
+                suppressed_sweeps[service['name']] = count
+                if count % suppress_every == 0:
+                    throttled.append(service)
+                    blockers[service['name']] = down_upstream
+                continue
+            suppressed_sweeps.pop(service['name'], None)
+
+            prev_status = service.get('prev_status')
+            if is_batched(service):
+                batched.append((service, prev_status))
+            else:
+                check(service)
+                requeue_if_recovered(service, prev_status)
+
+        if batched:
+            check_batch([service for service, _ in batched])
+            if heartbeat:
+                heartbeat()
+            for service, prev_status in batched:
+                requeue_if_recovered(service, prev_status)
+
+        if throttled:
+            probe_suppressed(throttled, blockers)
+        depth += 1
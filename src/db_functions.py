@@ -1,8 +1,13 @@
+import hashlib
+import json
 import os
+import sys
 import logging
-from datetime import datetime
-from pymongo import MongoClient
+from datetime import datetime, timedelta
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import PyMongoError
 from dotenv import load_dotenv
+from probes import get_probe_type
 
 # Load environment variables from .env file
 load_dotenv()
@@ -16,24 +21,110 @@ TEST_MODE = os.getenv("TEST_MODE", "false").lower() == "true"
 if TEST_MODE:
     MONGO_URI = os.getenv("MONGO_URI_TEST", "mongodb://localhost:27017/Qubit")
 
+# Fields the watchdogs read from a Watchdog_microservices document
+SERVICE_FIELDS = ("name", "url", "recipients", "prev_status", "probe_type", "expect", "depends_on")
+SERVICE_PROJECTION = dict({field: 1 for field in SERVICE_FIELDS}, _id=0)
+LOAD_BATCH_SIZE = int(os.getenv("LOAD_BATCH_SIZE", 1000))
+
+class ServiceRecord:
+    """
+    Compact in-memory copy of a Watchdog_microservices document. It supports the
+    same item access as the raw dict (service['name'], service.get('prev_status'))
+    so code can take either.
+    """
+    __slots__ = SERVICE_FIELDS
+
+    def __init__(self, name, url, recipients=(), prev_status=None, probe_type=None, expect=None, depends_on=()):
+        self.name = name
+        self.url = url
+        self.recipients = recipients
+        self.prev_status = prev_status
+        self.probe_type = probe_type
+        self.expect = expect
+        self.depends_on = depends_on
+
+    def __getitem__(self, key):
+        if key not in SERVICE_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in SERVICE_FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in SERVICE_FIELDS and getattr(self, key) is not None
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in SERVICE_FIELDS else None
+        return default if value is None else value
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in SERVICE_FIELDS}
+
+    def __repr__(self):
+        return f"ServiceRecord({self.to_dict()!r})"
+
+# Intern the string entries of a list field, skipping nulls and non-string values
+def _interned(values):
+    return tuple(sys.intern(v) for v in values or () if isinstance(v, str))
+
+# Build a ServiceRecord from a projected document. Strings that repeat across the
+# registry (recipient addresses, probe types, whole recipient lists) are shared.
+def make_service_record(doc, recipient_lists=None):
+    recipients = _interned(doc.get("recipients"))
+    if recipient_lists is not None:
+        recipients = recipient_lists.setdefault(recipients, recipients)
+    probe_type = doc.get("probe_type")
+    return ServiceRecord(
+        name=sys.intern(doc["name"]),
+        url=doc.get("url"),
+        recipients=recipients,
+        prev_status=doc.get("prev_status"),
+        probe_type=sys.intern(probe_type) if isinstance(probe_type, str) and probe_type else None,
+        expect=doc.get("expect"),
+        depends_on=_interned(doc.get("depends_on")),
+    )
+
+# Stream microservices from the collection in batches, yielding ServiceRecords
+def iter_microservices(mongo_uri=None, batch_size=LOAD_BATCH_SIZE):
+    # Use provided URI or fall back to the global one
+    if mongo_uri is None:
+        mongo_uri = MONGO_URI
+
+    # Establish MongoDB connection
+    client = MongoClient(mongo_uri)
+    db = client["Qubit"]
+    collection = db["Watchdog_microservices"]
+
+    try:
+        recipient_lists = {}
+        for doc in collection.find({}, SERVICE_PROJECTION, batch_size=batch_size):
+            yield make_service_record(doc, recipient_lists)
+    finally:
+        client.close()
+
 # Function to get all microservices stored in the collection
 def get_all_microservices(mongo_uri=None):
+    return list(iter_microservices(mongo_uri))
+
+# Function to create the indexes the watchdog queries rely on (no-op if they exist)
+def ensure_indexes(mongo_uri=None):
     # Use provided URI or fall back to the global one
     if mongo_uri is None:
         mongo_uri = MONGO_URI
-    
+
     # Establish MongoDB connection
     client = MongoClient(mongo_uri)
     db = client["Qubit"]
     collection = db["Watchdog_microservices"]
-    
-    # Get all microservices stored in the collection
-    microservices = collection.find()
-    microservices = list(microservices)
-    # print(list(microservices))
-    # print(mongo_uri)
-    client.close()
-    return list(microservices)
+
+    try:
+        collection.create_index("name")
+        collection.create_index("recipients")
+    finally:
+        client.close()
 
 # Function to update the prev_status field for a specific microservice by its name
 def update_prev_status(service_name, new_status, mongo_uri=None):
@@ -145,15 +236,19 @@ class MongoDBHandler(logging.Handler):
         self.collection = self.db[collection_name]
 
     def emit(self, record):
-        log_entry = self.format(record)
-        log_document = {
-            "timestamp": datetime.utcnow(),
-            "level": record.levelname,
-            "message": log_entry,
-            "logger": record.name,
-        }
-        # Insert log document into MongoDB
-        self.collection.insert_one(log_document)
+        try:
+            log_entry = self.format(record)
+            log_document = {
+                "timestamp": datetime.utcnow(),
+                "level": record.levelname,
+                "message": log_entry,
+                "logger": record.name,
+            }
+            # Insert log document into MongoDB
+            self.collection.insert_one(log_document)
+        except Exception:
+            # Never let a Mongo hiccup propagate into the code that is logging
+            self.handleError(record)
 
 def create_mongo_logger(mongo_uri=None, 
                         db_name=DEFAULT_DB_NAME, 
@@ -177,4 +272,94 @@ def create_mongo_logger(mongo_uri=None,
         
     logger.addHandler(mongo_handler)
     
-    return logger
\ No newline at end of file
+    return logger
+
+####################################################################################
+########################### PROBE CACHE FUNCTIONS BELOW ############################
+####################################################################################
+PROBE_CACHE_COLLECTION_NAME = 'probe_cache'
+
+# What a cached result was probed with. A result only stands in for a probe that would
+# check the same thing: same URL, same probe type and the same content assertion.
+def probe_signature(service):
+    expect = service.get('expect')
+    expect_hash = None
+    if expect:
+        expect_hash = hashlib.sha1(json.dumps(expect, sort_keys=True, default=str).encode()).hexdigest()
+    return {"url": service['url'], "probe_type": get_probe_type(service), "expect_hash": expect_hash}
+
+class ProbeCache:
+    """
+    Probe results shared between watchdogs through Mongo. A result younger than `ttl`
+    seconds is reused instead of probing the service again; a TTL index on expires_at
+    lets Mongo delete old results. A watchdog only reads results stored by another
+    source, so it never replays its own stale probe. Cache errors count as misses so
+    probing never depends on the cache being up.
+    """
+
+    def __init__(self, ttl, source, mongo_uri=None,
+                 db_name=DEFAULT_DB_NAME, collection_name=PROBE_CACHE_COLLECTION_NAME):
+        # Use provided URI or fall back to the global one
+        if mongo_uri is None:
+            mongo_uri = MONGO_URI
+
+        self.ttl = ttl
+        self.source = source
+        self.client = MongoClient(mongo_uri)
+        self.collection = self.client[db_name][collection_name]
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "errors": 0}
+
+    def ensure_index(self):
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def get(self, service):
+        return self.get_many([service]).get(service['name'])
+
+    # Fresh results for the given services as {name: (healthy, reason)}; misses are left out
+    def get_many(self, services):
+        if not services:
+            return {}
+        signatures = {service['name']: probe_signature(service) for service in services}
+        try:
+            docs = self.collection.find(
+                {"_id": {"$in": list(signatures)}, "expires_at": {"$gt": datetime.utcnow()},
+                 "source": {"$ne": self.source}},
+                {"url": 1, "probe_type": 1, "expect_hash": 1, "healthy": 1, "reason": 1}
+            )
+            results = {doc["_id"]: (doc["healthy"], doc.get("reason")) for doc in docs
+                       if all(doc.get(field) == value for field, value in signatures[doc["_id"]].items())}
+        except PyMongoError:
+            self.stats["errors"] += 1
+            results = {}
+        self.stats["hits"] += len(results)
+        self.stats["misses"] += len(services) - len(results)
+        return results
+
+    def put(self, service, healthy, reason=None):
+        self.put_many([(service, healthy, reason)])
+
+    # Store results from (service, healthy, reason) tuples in one bulk write
+    def put_many(self, results):
+        if not results:
+            return
+        checked_at = datetime.utcnow()
+        expires_at = checked_at + timedelta(seconds=self.ttl)
+        operations = [
+            UpdateOne({"_id": service['name']}, {"$set": dict(
+                probe_signature(service),
+                healthy=healthy,
+                reason=reason,
+                checked_at=checked_at,
+                expires_at=expires_at,
+                source=self.source
+            )}, upsert=True)
+            for service, healthy, reason in results
+        ]
+        try:
+            self.collection.bulk_write(operations, ordered=False)
+            self.stats["stores"] += len(operations)
+        except PyMongoError:
+            self.stats["errors"] += 1
+
+    def get_stats(self):
+        return dict(self.stats, ttl=self.ttl)
@@ -0,0 +1,120 @@
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class DependencyGraph:
+    """
+    DAG built from the optional "depends_on" list of each Watchdog_microservices
+    document. Edges to unknown services are dropped, as are the edges of any
+    service caught in a cycle, so the graph is always acyclic.
+    """
+
+    def __init__(self, services):
+        self.services = {service['name']: service for service in services}
+        self.parents = {}
+        self.children = {name: [] for name in self.services}
+
+        for name, service in self.services.items():
+            parents = []
+            for dependency in service.get('depends_on') or ():
+                if dependency not in self.services:
+                    logger.warning(f"{name} depends on unknown service {dependency}, ignoring")
+                elif dependency != name and dependency not in parents:
+                    parents.append(dependency)
+            self.parents[name] = parents
+
+        self.cycles = self._break_cycles()
+        for name, parents in self.parents.items():
+            for parent in parents:
+                self.children[parent].append(name)
+        self.depth = self._compute_depths()
+
+    # Kahn's algorithm run forwards and then backwards: what survives both peels sits
+    # on a cycle (or between two), and the edges among those services are dropped
+    def _break_cycles(self):
+        dependents = {name: [] for name in self.services}
+        for name, parents in self.parents.items():
+            for parent in parents:
+                dependents[parent].append(name)
+
+        remaining = set(self.services)
+        for edges, reverse in ((self.parents, dependents), (dependents, self.parents)):
+            degree = {name: sum(1 for n in edges[name] if n in remaining) for name in remaining}
+            queue = deque(name for name in remaining if degree[name] == 0)
+            while queue:
+                name = queue.popleft()
+                remaining.discard(name)
+                for other in reverse[name]:
+                    if other in remaining:
+                        degree[other] -= 1
+                        if degree[other] == 0:
+                            queue.append(other)
+
+        cyclic = sorted(remaining)
+        if cyclic:
+            logger.error(f"Dependency cycle between {', '.join(cyclic)}, ignoring depends_on among them")
+            for name in cyclic:
+                self.parents[name] = [p for p in self.parents[name] if p not in remaining]
+        return cyclic
+
+    def _compute_depths(self):
+        depth = {}
+        queue = deque(name for name, parents in self.parents.items() if not parents)
+        remaining = {name: len(parents) for name, parents in self.parents.items()}
+        for name in queue:
+            depth[name] = 0
+        while queue:
+            name = queue.popleft()
+            for child in self.children[name]:
+                depth[child] = max(depth.get(child, 0), depth[name] + 1)
+                remaining[child] -= 1
+                if remaining[child] == 0:
+                    queue.append(child)
+        return depth
+
+    # Group services by depth so every dependency is probed before its dependents
+    def group_by_level(self, services):
+        levels = {}
+        for service in services:
+            levels.setdefault(self.depth.get(service['name'], 0), []).append(service)
+        return levels
+
+    def descendants(self, name):
+        seen = []
+        queue = deque(self.children.get(name, ()))
+        visited = set()
+        while queue:
+            child = queue.popleft()
+            if child in visited:
+                continue
+            visited.add(child)
+            seen.append(child)
+            queue.extend(self.children[child])
+        return seen
+
+    # Upstream services currently marked down, i.e. the reasons `name` can't be healthy
+    def down_ancestors(self, name):
+        down = []
+        queue = deque(self.parents.get(name, ()))
+        visited = set()
+        while queue:
+            parent = queue.popleft()
+            if parent in visited:
+                continue
+            visited.add(parent)
+            if self.services[parent].get('prev_status') == False:
+                down.append(parent)
+            queue.extend(self.parents[parent])
+        return down
+
+    # Recipients of everything downstream of `name` who aren't already on its own alert
+    def subtree_recipients(self, name):
+        seen = set(self.services[name].get('recipients') or ())
+        recipients = []
+        for child in self.descendants(name):
+            for recipient in self.services[child].get('recipients') or ():
+                if recipient not in seen:
+                    seen.add(recipient)
+                    recipients.append(recipient)
+        return recipients
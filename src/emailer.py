@@ -1,43 +1,366 @@
 import smtplib
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
-def send_email(subject, body, recipients):
-    """Generate and send an email to multiple recipients."""
-    
-    # Fetching credentials from environment variables
-    sender_email = os.getenv('EMAIL_ADDRESS')
-    sender_password = os.getenv('EMAIL_PASSWORD')
-
-    # Set up the MIME
-    msg = MIMEMultipart()
-    msg['From'] = sender_email
-    msg['Subject'] = subject
-    
-    # Attach the body with the msg instance
-    msg.attach(MIMEText(body, 'plain'))
-
-    try:
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(sender_email, sender_password)
 
+SMTP_HOST = os.getenv('SMTP_HOST', 'smtp.gmail.com')
+SMTP_PORT = int(os.getenv('SMTP_PORT', 587))
+
+# Token bucket limits: refill rate in messages per minute and burst size
+MAIL_SENDER_RATE = float(os.getenv('MAIL_SENDER_RATE', 20))
+MAIL_SENDER_BURST = int(os.getenv('MAIL_SENDER_BURST', 10))
+MAIL_DOMAIN_RATE = float(os.getenv('MAIL_DOMAIN_RATE', 10))
+MAIL_DOMAIN_BURST = int(os.getenv('MAIL_DOMAIN_BURST', 5))
+MAIL_MAX_ATTEMPTS = int(os.getenv('MAIL_MAX_ATTEMPTS', 5))
+MAIL_RETRY_DELAY = float(os.getenv('MAIL_RETRY_DELAY', 30))
+
+# Lower value is sent first, so "down" alerts overtake "up" alerts in a backlog
+PRIORITY_DOWN = 0
+PRIORITY_NORMAL = 1
+PRIORITY_UP = 2
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per minute, holding at most `capacity`."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate / 60.0
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+    # Seconds until the next token is available (0 if one is available now)
+    def wait_time(self):
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class MailJob:
+    __slots__ = ("priority", "subject", "body", "domain", "recipients", "topic", "attempts")
+
+    def __init__(self, priority, subject, body, domain, recipients, topic=None):
+        self.priority = priority
+        self.subject = subject
+        self.body = body
+        self.domain = domain
+        self.recipients = recipients
+        self.topic = topic
+        self.attempts = 0
+
+    @property
+    def key(self):
+        return (self.subject, self.body, self.domain)
+
+    @property
+    def topic_key(self):
+        return (self.topic, self.domain)
+
+def recipient_domain(recipient):
+    return recipient.rsplit('@', 1)[-1].lower()
+
+class MailQueue:
+    """
+    Rate limited outbound mail. Identical messages are sent once per recipient
+    domain as a single multi-RCPT transaction, throttled jobs wait in the queue
+    instead of being dropped, and failed sends are retried. Priority only reorders
+    mail across topics (services): mail on one topic goes out in the order it was queued.
+    """
+
+    def __init__(self, sender_email=None, sender_password=None, smtp_factory=None, clock=time.monotonic,
+                 sender_rate=None, sender_burst=None, domain_rate=None, domain_burst=None, logger=None):
+        self.sender_email = sender_email
+        self.sender_password = sender_password
+        self.smtp_factory = smtp_factory or (lambda: smtplib.SMTP(SMTP_HOST, SMTP_PORT))
+        self.clock = clock
+        self.sender_rate = MAIL_SENDER_RATE if sender_rate is None else sender_rate
+        self.sender_burst = MAIL_SENDER_BURST if sender_burst is None else sender_burst
+        self.domain_rate = MAIL_DOMAIN_RATE if domain_rate is None else domain_rate
+        self.domain_burst = MAIL_DOMAIN_BURST if domain_burst is None else domain_burst
+        self.logger = logger or logging.getLogger(__name__)
+        # Log lines produced under the lock, written out once it is released: the logger
+        # may be the Mongo logger, and a slow insert must not hold up enqueue()
+        self.notes = []
+        self.sender_buckets = {}
+        self.domain_buckets = {}
+        self.ready = []     # heap of (priority, seq, job)
+        self.delayed = []   # heap of (not_before, seq, job)
+        self.pending = {}   # job key -> job still waiting in the queue, used to merge duplicates
+        self.topics = {}    # (topic, domain) -> jobs in queued order; only the first is in a heap
+        self.seq = itertools.count()
+        self.condition = threading.Condition()
+        self.worker = None
+        self.stats = {"sent": 0, "batches": 0, "throttled": 0, "retried": 0, "failed": 0, "merged": 0}
+
+    def _sender(self):
+        return self.sender_email or os.getenv('EMAIL_ADDRESS')
+
+    def _bucket(self, buckets, key, rate, burst):
+        if key not in buckets:
+            buckets[key] = TokenBucket(rate, burst, clock=self.clock)
+        return buckets[key]
+
+    def enqueue(self, subject, body, recipients, priority=PRIORITY_NORMAL, topic=None):
+        by_domain = {}
         for recipient in recipients:
-            try:
-                msg['To'] = recipient
-                text = msg.as_string()
-                server.sendmail(sender_email, recipient, text)
-                print(f"Email sent successfully to {recipient}")
-            except Exception as e:
-                print(f"Failed to send email to {recipient}. Error: {e}")
-        
-        server.quit()
-
-    except Exception as e:
-        print(f"Failed to connect to the email server. Error: {e}")
+            by_domain.setdefault(recipient_domain(recipient), []).append(recipient)
+
+        with self.condition:
+            for domain, domain_recipients in by_domain.items():
+                job = MailJob(priority, subject, body, domain, domain_recipients, topic)
+                queued = self.pending.get(job.key)
+                if queued is not None and self._is_latest(queued):
+                    # Same message to the same domain is already waiting, just add the recipients
+                    queued.recipients.extend(r for r in domain_recipients if r not in queued.recipients)
+                    self.stats["merged"] += 1
+                    if priority < queued.priority:
+                        self._raise_priority(queued, priority)
+                    continue
+                self.pending.setdefault(job.key, job)
+                if topic is not None:
+                    line = self.topics.setdefault(job.topic_key, deque())
+                    line.append(job)
+                    if len(line) > 1:
+                        # Waits behind earlier mail on its topic, which it may hurry along
+                        if priority < line[0].priority:
+                            self._raise_priority(line[0], priority)
+                        continue
+                heapq.heappush(self.ready, (job.priority, next(self.seq), job))
+            self.condition.notify()
+
+    # Merging into a job is only safe if nothing on its topic was queued after it,
+    # otherwise the merged recipients would get the newer message too early
+    def _is_latest(self, job):
+        return job.topic is None or self.topics[job.topic_key][-1] is job
+
+    def _next_on_topic(self, job, other):
+        if job.topic is None:
+            return True
+        line = self.topics[job.topic_key]
+        return len(line) > 1 and line[1] is other
+
+    def _raise_priority(self, job, priority):
+        job.priority = min(job.priority, priority)
+        if job.topic is not None:
+            head = self.topics[job.topic_key][0]
+            head.priority = min(head.priority, priority)
+        self._rebuild_ready()
+
+    def _forget(self, job):
+        if self.pending.get(job.key) is job:
+            del self.pending[job.key]
+
+    # A job is done (sent or given up on): let the next job on its topic go
+    def _finish(self, job):
+        if job.topic is None:
+            return
+        line = self.topics[job.topic_key]
+        line.popleft()
+        if not line:
+            del self.topics[job.topic_key]
+            return
+        following = line[0]
+        following.priority = min(queued.priority for queued in line)
+        heapq.heappush(self.ready, (following.priority, next(self.seq), following))
+
+    def _rebuild_ready(self):
+        self.ready = [(job.priority, seq, job) for _, seq, job in self.ready]
+        heapq.heapify(self.ready)
+
+    def _promote_delayed(self):
+        now = self.clock()
+        while self.delayed and self.delayed[0][0] <= now:
+            _, seq, job = heapq.heappop(self.delayed)
+            heapq.heappush(self.ready, (job.priority, seq, job))
+
+    def _delay(self, job, seconds):
+        heapq.heappush(self.delayed, (self.clock() + seconds, next(self.seq), job))
+
+    def _waiting(self):
+        return sum(len(line) - 1 for line in self.topics.values())
+
+    def _depth(self):
+        return len(self.ready) + len(self.delayed) + self._waiting()
+
+    def depth(self):
+        with self.condition:
+            return self._depth()
+
+    def get_stats(self):
+        with self.condition:
+            stats = dict(self.stats)
+            stats["queued"] = len(self.ready) + self._waiting()
+            stats["delayed"] = len(self.delayed)
+            return stats
+
+    # Take the most urgent job that both buckets allow right now.
+    # Throttled jobs are moved to the delayed heap until their tokens refill.
+    def _next_job(self):
+        self._promote_delayed()
+        sender = self._sender()
+        throttled = {}
+        try:
+            while self.ready:
+                _, _, job = heapq.heappop(self.ready)
+                sender_bucket = self._bucket(self.sender_buckets, sender, self.sender_rate, self.sender_burst)
+                domain_bucket = self._bucket(self.domain_buckets, job.domain, self.domain_rate, self.domain_burst)
+                wait = max(sender_bucket.wait_time(), domain_bucket.wait_time())
+                if wait > 0:
+                    self.stats["throttled"] += 1
+                    throttled[job.domain] = max(wait, throttled.get(job.domain, 0.0))
+                    self._delay(job, wait)
+                    continue
+                sender_bucket.consume()
+                domain_bucket.consume()
+                self._forget(job)
+                return job
+            return None
+        finally:
+            # One line per pass rather than one per throttled job
+            if throttled:
+                domains = ", ".join(f"{domain} ({wait:.1f}s)" for domain, wait in sorted(throttled.items()))
+                self.notes.append(("warning", f"Throttled email to {domains}; {self._depth()} queued"))
+
+    def _send(self, server, job):
+        msg = MIMEMultipart()
+        msg['From'] = self._sender()
+        # Recipients on the same domain share a message, so keep their addresses
+        # in the envelope only rather than showing them to each other
+        msg['To'] = "undisclosed-recipients:;"
+        msg['Subject'] = job.subject
+        msg.attach(MIMEText(job.body, 'plain'))
+        # One transaction with a RCPT TO per recipient on this domain
+        server.sendmail(self._sender(), job.recipients, msg.as_string())
+
+    def _retry(self, job, error):
+        job.attempts += 1
+        if job.attempts >= MAIL_MAX_ATTEMPTS:
+            self.stats["failed"] += 1
+            self.notes.append(("error", f"Giving up on email to {', '.join(job.recipients)} "
+                                     f"after {job.attempts} attempts. Error: {error}"))
+            self._finish(job)
+            return
+        self.stats["retried"] += 1
+        self.notes.append(("warning", f"Failed to send email to {', '.join(job.recipients)}, "
+                                       f"retrying. Error: {error}"))
+        existing = self.pending.get(job.key)
+        # Fold into an identical queued job, unless other mail on the topic sits between them
+        if existing is not None and self._next_on_topic(job, existing):
+            existing.recipients.extend(r for r in job.recipients if r not in existing.recipients)
+            self._finish(job)
+            return
+        self.pending.setdefault(job.key, job)
+        self._delay(job, MAIL_RETRY_DELAY * job.attempts)
+
+    def _flush_notes(self):
+        with self.condition:
+            notes, self.notes = self.notes, []
+        for level, message in notes:
+            getattr(self.logger, level)(message)
+
+    def _connect(self):
+        server = self.smtp_factory()
+        server.starttls()
+        server.login(self._sender(), self.sender_password or os.getenv('EMAIL_PASSWORD'))
+        return server
+
+    # Send everything that is currently allowed over one SMTP connection.
+    # Returns the number of seconds until more work could become ready (None if the queue is empty).
+    def run_once(self):
+        server = None
+        try:
+            while True:
+                with self.condition:
+                    job = self._next_job()
+                self._flush_notes()
+                if job is None:
+                    break
+                try:
+                    if server is None:
+                        server = self._connect()
+                    self._send(server, job)
+                    with self.condition:
+                        self.stats["sent"] += len(job.recipients)
+                        self.stats["batches"] += 1
+                        self._finish(job)
+                    self.logger.info(f"Email sent successfully to {', '.join(job.recipients)}")
+                except Exception as e:
+                    with self.condition:
+                        self._retry(job, e)
+                    self._flush_notes()
+                    # The connection may be unusable now, reconnect for the next job
+                    if server is not None:
+                        try:
+                            server.quit()
+                        except Exception:
+                            pass
+                        server = None
+        finally:
+            if server is not None:
+                try:
+                    server.quit()
+                except Exception:
+                    pass
+
+        with self.condition:
+            if self.ready:
+                return 0.0
+            if self.delayed:
+                return max(0.0, self.delayed[0][0] - self.clock())
+            return None
+
+    def _run(self):
+        while True:
+            wait = self.run_once()
+            with self.condition:
+                if not self.ready:
+                    self.condition.wait(timeout=wait)
+
+    def start(self):
+        with self.condition:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._run, name="mail-queue")
+                self.worker.daemon = True
+                self.worker.start()
+
+# Process wide queue used by send_email
+mail_queue = MailQueue()
+
+# Route the queue's delivery, retry and throttle messages to the watchdog's own log
+def set_mail_logger(mail_logger):
+    mail_queue.logger = mail_logger
+
+def send_email(subject, body, recipients, priority=PRIORITY_NORMAL, topic=None):
+    """
+    Queue an email to multiple recipients; it is sent as soon as the rate limits allow.
+    Emails sharing a topic, e.g. alerts about one service, keep the order they were queued in.
+    """
+    if not recipients:
+        return
+    mail_queue.enqueue(subject, body, list(recipients), priority=priority, topic=topic)
+    mail_queue.start()
+
+def get_mail_stats():
+    """Queue depth and throttle counters of the outbound mail queue."""
+    return mail_queue.get_stats()
 
 # Example usage:
 # recipients_list = ["nopenah100@gmail.com"]
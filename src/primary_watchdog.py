@@ -1,47 +1,175 @@
+import json
 import threading
 import time
 import requests
 import logging
 import os
-from flask import Flask, request, jsonify
-from emailer import send_email
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, Response, request, jsonify
+from emailer import send_email, set_mail_logger, get_mail_stats, PRIORITY_DOWN, PRIORITY_UP
+from probes import (
+    probe_http,
+    probe_batch,
+    compile_assertions,
+    get_probe_type,
+    SingleFlight,
+    PROBE_HTTP_GET
+)
 from dotenv import load_dotenv
 from db_functions import (
+    SERVICE_FIELDS,
+    ensure_indexes,
     get_all_microservices,
     update_prev_status,
     update_recipients,
-    create_mongo_logger
+    create_mongo_logger,
+    ProbeCache
 )
+from dependencies import DependencyGraph
+from alerting import alert_message, apply_probe_result, root_cause_message, sweep_services, transition
+from profiler import debug_blueprint
 
 # Load .env file from the parent directory
 load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.env'))
 
 # Initialize Flask app
 app = Flask(__name__)
+# /debug/profile and /debug/threads, disabled unless DEBUG_ENDPOINTS_ENABLED is set
+app.register_blueprint(debug_blueprint)
 
 # Flag for refreshing microservices list
 refresh_flag = False
 
-# Load the microservices at startup
-microservices = get_all_microservices()
+# Serializes registry reloads so a slow reload can never replace a newer one, and lets
+# the monitor take microservices and dependency_graph from the same reload
+registry_lock = threading.Lock()
+
+microservices = []
+dependency_graph = DependencyGraph([])
+
+# Load the microservices along with everything derived from them. Services we already
+# know keep their record, updated in place, so a sweep still running on the previous
+# list shares prev_status with the new one and can't alert twice for one transition.
+def load_registry():
+    global microservices, dependency_graph
+    with registry_lock:
+        current = {service['name']: service for service in microservices}
+        services = []
+        for service in get_all_microservices():
+            existing = current.get(service['name'])
+            if existing is None:
+                services.append(service)
+                continue
+            for field in SERVICE_FIELDS:
+                if field != 'prev_status':
+                    existing[field] = service.get(field)
+            services.append(existing)
+        compile_assertions(services)
+        graph = DependencyGraph(services)
+        microservices, dependency_graph = services, graph
+    return services
+
+def registry_snapshot():
+    with registry_lock:
+        return microservices, dependency_graph
+
+# Make sure the registry indexes exist, then load the microservices at startup
+ensure_indexes()
+load_registry()
+
+# Sweeps each service has sat out while an upstream dependency is down
+suppressed_sweeps = {}
 
 # Configure MongoDB logging
 mongo_logger = create_mongo_logger(log_level=logging.DEBUG)
+# Mail delivery failures and throttling go to the logs collection too
+set_mail_logger(mongo_logger)
 
 SLEEP_TIME = 30 if os.getenv("TEST_MODE", "false").lower() == "true" else 300
 SERVER_ADDRESS = os.getenv("FLASK_RUN_HOST", "127.0.0.1")
 PORT = int(os.getenv("FLASK_RUN_PORT", 5000))
 
+# While an upstream dependency is down, dependents are only probed every this many sweeps
+SUPPRESSED_PROBE_EVERY = int(os.getenv("SUPPRESSED_PROBE_EVERY", 5))
+
+# Probe results younger than this many seconds are shared with the secondary watchdog
+# through Mongo instead of probing the service again (0 disables the cache)
+PROBE_CACHE_TTL = float(os.getenv("PROBE_CACHE_TTL", 0))
+probe_cache = None
+if PROBE_CACHE_TTL > 0:
+    probe_cache = ProbeCache(PROBE_CACHE_TTL, source="primary")
+    probe_cache.ensure_index()
+
+# A sweep running longer than this counts as stalled
+SWEEP_DEADLINE = float(os.getenv("SWEEP_DEADLINE", SLEEP_TIME))
+# Worker threads for on-demand /check probes; http_head and tcp_connect services
+# of one request share a worker on the multiplexer
+CHECK_WORKERS = int(os.getenv("CHECK_WORKERS", 16))
+check_executor = ThreadPoolExecutor(max_workers=CHECK_WORKERS, thread_name_prefix="check")
+# Concurrent /check requests for the same service wait on one in-flight probe
+check_flight = SingleFlight()
+
+# Held while a probe result is applied, so the monitor loop and /check can't both
+# see the same transition and alert twice
+record_lock = threading.Lock()
+
+# Backoff between restarts of a crashed monitor loop (seconds)
+RESTART_BACKOFF_MIN = float(os.getenv("RESTART_BACKOFF_MIN", 1))
+RESTART_BACKOFF_MAX = float(os.getenv("RESTART_BACKOFF_MAX", 60))
+
+# Health of the monitor loop, written by the loop and read by /status
+monitor_state = {
+    "started_at": time.time(),
+    "heartbeat": None,       # last time the loop made progress
+    "sweep_started": None,   # set while a sweep is in progress
+    "last_success": None,    # when the last sweep completed
+    "restarts": 0,
+    "last_error": None
+}
+
+# Work out whether the monitor loop is actually watching. Returns (healthy, details).
+def get_monitor_health(now=None):
+    now = time.time() if now is None else now
+    state = dict(monitor_state)
+    last_success = state["last_success"] or state["started_at"]
+    sweep_age = now - last_success
+    running_for = now - state["sweep_started"] if state["sweep_started"] else 0.0
+
+    # Between sweeps the loop sleeps SLEEP_TIME, so allow that on top of the deadline
+    stalled = running_for > SWEEP_DEADLINE
+    stale = sweep_age > SLEEP_TIME + SWEEP_DEADLINE
+    details = {
+        "last_successful_sweep_age": round(sweep_age, 1),
+        "sweep_running_for": round(running_for, 1),
+        "heartbeat_age": round(now - state["heartbeat"], 1) if state["heartbeat"] else None,
+        "stalled": stalled,
+        "restarts": state["restarts"],
+        "last_error": state["last_error"]
+    }
+    return not (stalled or stale), details
+
 @app.route('/status')
 def status():
-    # Primary Watchdog status endpoint to report if it's alive
-    return jsonify({"status": "alive", "message": "Primary Watchdog is running."}), 200
+    # Primary Watchdog status endpoint; only reports alive while the monitor loop is sweeping
+    healthy, monitor = get_monitor_health()
+    if not healthy:
+        return jsonify({
+            "status": "unhealthy",
+            "message": "Primary Watchdog monitor loop is not sweeping.",
+            "monitor": monitor,
+            "mail": get_mail_stats()
+        }), 503
+    return jsonify({
+        "status": "alive",
+        "message": "Primary Watchdog is running.",
+        "monitor": monitor,
+        "mail": get_mail_stats(),
+        "probe_cache": probe_cache.get_stats() if probe_cache is not None else None,
+        "checks": check_flight.get_stats()
+    }), 200
 
 @app.route('/subscribe', methods=['POST'])
 def subscribe():
-
-    global microservices
-
     data = request.get_json()
     service_name = data.get("service_name")
     gmail_id = data.get("gmail_id")
@@ -55,7 +183,7 @@ def subscribe():
         success = update_recipients(service_name, gmail_id, add=True)
         if success:
             # Refresh our local copy to reflect the update
-            microservices = get_all_microservices()
+            load_registry()
             mongo_logger.info(f"Subscribed {gmail_id} to {service_name}")
             return jsonify({"message": f"Subscribed {gmail_id} to {service_name}"}), 200
         else:
@@ -65,7 +193,6 @@ def subscribe():
 
 @app.route('/unsubscribe', methods=['POST'])
 def unsubscribe():
-    global microservices
     data = request.get_json()
     service_name = data.get("service_name")
     gmail_id = data.get("gmail_id")
@@ -79,7 +206,7 @@ def unsubscribe():
         success = update_recipients(service_name, gmail_id, add=False)
         if success:
             # Refresh our local copy to reflect the update
-            microservices = get_all_microservices()
+            load_registry()
             mongo_logger.info(f"Unsubscribed {gmail_id} from {service_name}")
             return jsonify({"message": f"Unsubscribed {gmail_id} from {service_name}"}), 200
         else:
@@ -95,59 +222,253 @@ def refresh():
 
 def send_alert(service_name, recipients, alert_type="down"):
     try:
-        subject = f"ALERT: {service_name} is {alert_type}!"
-        body = f"The microservice {service_name} is {alert_type}. Please check the service."
-        send_email(subject, body, recipients)
-        mongo_logger.info(f"Alert sent for {service_name}: {alert_type}")
+        subject, body = alert_message(service_name, alert_type)
+        priority = PRIORITY_DOWN if alert_type == "down" else PRIORITY_UP
+        # Alerts about one service keep their order, so recipients never end on a stale state
+        send_email(subject, body, recipients, priority=priority, topic=service_name)
+        mongo_logger.info(f"Alert queued for {service_name}: {alert_type}")
     except Exception as e:
         mongo_logger.error(f"Failed to send alert for {service_name}: {e}")
 
-def check_service_health(service):
+# Apply a probe outcome to a service, whichever probe type produced it.
+# Alerts go out on transitions only and Mongo is only written when prev_status changes.
+# The transition is worked out under record_lock, so when the monitor loop and /check
+# record the same change only the first sends the alert and the root cause alert.
+# Returns the status the service had before.
+def record_probe_result(service, healthy, reason=None, graph=None):
+    with record_lock:
+        prev_status = apply_probe_result(service, healthy, reason,
+                                         send_alert=send_alert,
+                                         persist_status=update_prev_status,
+                                         logger=mongo_logger)
+    alert_type = transition(prev_status, healthy)
+    if alert_type is not None:
+        send_root_cause_alert(service, alert_type, graph)
+    return prev_status
+
+# Run the HTTP GET probe for a service, unless a peer probed it recently (`fresh` always probes).
+# Returns (healthy, reason) and never raises for network errors.
+def probe_service(service, fresh=False):
+    if probe_cache is not None and not fresh:
+        cached = probe_cache.get(service)
+        if cached is not None:
+            return cached
     try:
-        # Add /status to the URL if it's not already there
-        url = service['url']
-        
-        response = requests.get(url, timeout=5)
-        if response.status_code == 200:
-            if service.get('prev_status') == False:
-                mongo_logger.info(f"{service['name']} is back up.")
-                send_alert(service['name'], service['recipients'], alert_type="up")
-            update_prev_status(service['name'], True)
-            mongo_logger.info(f"{service['name']} is healthy.")
-            return True
-        else:
-            if service.get('prev_status') == True:
-                mongo_logger.error(f"{service['name']} returned status code {response.status_code}")
-                send_alert(service['name'], service['recipients'], alert_type="down")
-            update_prev_status(service['name'], False)
-            mongo_logger.info(f"{service['name']} is down.")
-            return False
+        # Stream the response and only read as much of the body as the service's expect spec needs
+        result = probe_http(service)
     except requests.exceptions.RequestException as e:
-        if service.get('prev_status') == True:
-            mongo_logger.error(f"Error while checking {service['name']}: {e}")
-            send_alert(service['name'], service['recipients'], alert_type="down")
-        update_prev_status(service['name'], False)
-        mongo_logger.info(f"{service['name']} is down.")
-        return False
+        result = (False, f"unreachable: {e}")
+    if probe_cache is not None:
+        probe_cache.put(service, *result)
+    return result
 
-def monitor_services():
+# Probe cheap (http_head / tcp_connect) services on the multiplexer, reusing fresh cached results
+def probe_services_batch(services, fresh=False):
+    results = probe_cache.get_many(services) if probe_cache is not None and not fresh else {}
+    missing = [service for service in services if service['name'] not in results]
+    if missing:
+        probed = probe_batch(missing)
+        if probe_cache is not None:
+            probe_cache.put_many([(service, *probed[service['name']]) for service in missing])
+        results.update(probed)
+    return results
+
+def check_service_health(service, graph=None):
+    healthy, reason = probe_service(service)
+    record_probe_result(service, healthy, reason, graph=graph)
+    return healthy
+
+# http_head and tcp_connect services are checked together on the non-blocking multiplexer
+def check_services_batch(services, graph=None):
+    results = probe_services_batch(services)
+    for service in services:
+        record_probe_result(service, *results[service['name']], graph=graph)
+
+def is_batched(service):
+    return get_probe_type(service) != PROBE_HTTP_GET
+
+# One alert for everyone downstream of a service that changed state, instead of
+# each dependent alerting on its own
+def send_root_cause_alert(service, alert_type="down", graph=None):
     try:
-        global microservices, refresh_flag
-        while True:
-            if refresh_flag:
-                mongo_logger.info("Refreshing microservices list...")
-                microservices = get_all_microservices()
-                mongo_logger.info("Microservices list refreshed.")
-                refresh_flag = False
-
-            for service in microservices:
-                check_service_health(service)
-            time.sleep(SLEEP_TIME)
+        message = root_cause_message(graph or dependency_graph, service, alert_type)
+        if message is None:
+            return
+        subject, body, recipients = message
+        priority = PRIORITY_DOWN if alert_type == "down" else PRIORITY_UP
+        send_email(subject, body, recipients, priority=priority, topic=service['name'])
+        mongo_logger.info(f"Root cause alert queued for {service['name']}: {alert_type}")
     except Exception as e:
-        mongo_logger.error(f"Error in monitoring services: {e}")
+        mongo_logger.error(f"Failed to send root cause alert for {service['name']}: {e}")
+
+# Throttled probe of a service whose upstream is down. The result is only logged:
+# the dependent's own state and alerts wait until the upstream recovers.
+def probe_suppressed(services, blockers):
+    batched = [s for s in services if is_batched(s)]
+    results = probe_services_batch(batched) if batched else {}
+    for service in services:
+        if not is_batched(service):
+            results[service['name']] = probe_service(service)
+    for service in services:
+        healthy, _ = results[service['name']]
+        mongo_logger.info(f"{service['name']} is {'healthy' if healthy else 'down'} "
+                          f"while {', '.join(blockers[service['name']])} is down.")
+
+# Record an on-demand result the way a sweep would: a service whose upstream is down only
+# logs, and a transition gets the usual alert plus one root cause alert for its subtree.
+# Like a sweep, a recovery re-checks the whole subtree right away, as that alert promises.
+def record_check_result(service, healthy, reason, graph):
+    blocked_by = graph.down_ancestors(service['name'])
+    if blocked_by:
+        mongo_logger.info(f"{service['name']} is {'healthy' if healthy else 'down'} "
+                          f"while {', '.join(blocked_by)} is down.")
+    else:
+        prev_status = record_probe_result(service, healthy, reason, graph)
+        if transition(prev_status, healthy) == "up":
+            start_checks([graph.services[name] for name in graph.descendants(service['name'])], graph)
+    return {"name": service['name'], "healthy": healthy, "reason": reason, "blocked_by": blocked_by}
+
+def probe_single(services):
+    return {service['name']: probe_service(service, fresh=True) for service in services}
+
+def probe_batched(services):
+    return probe_services_batch(services, fresh=True)
+
+# Probe a group of claimed services on a /check worker, record them and wake everyone waiting
+def run_check(services, graph, probe):
+    try:
+        results = probe(services)
+    except Exception as e:
+        mongo_logger.error(f"On-demand check of {', '.join(s['name'] for s in services)} failed: {e}")
+        for service in services:
+            check_flight.resolve(service['name'], error=e)
+        return
+    for service in services:
+        try:
+            outcome = record_check_result(service, *results[service['name']], graph)
+        except Exception as e:
+            check_flight.resolve(service['name'], error=e)
+        else:
+            check_flight.resolve(service['name'], outcome)
+
+# Probe the services right away. Returns {name: Future}; services another request is
+# already probing share that probe instead of starting a new one.
+def start_checks(services, graph):
+    futures, owned = check_flight.claim(services)
+    batched = [service for service in owned if is_batched(service)]
+    if batched:
+        check_executor.submit(run_check, batched, graph, probe_batched)
+    for service in owned:
+        if not is_batched(service):
+            check_executor.submit(run_check, [service], graph, probe_single)
+    return futures
+
+def check_outcome(name, future):
+    try:
+        return future.result()
+    except Exception as e:
+        return {"name": name, "healthy": None, "reason": f"check failed: {e}", "blocked_by": []}
+
+# Check services now instead of waiting for the next sweep, e.g. from a deploy hook.
+# Body: {"services": ["name", ...] | "all", "stream": false}. With stream, one JSON
+# line is sent per service as its probe finishes.
+@app.route('/check', methods=['POST'])
+def check():
+    data = request.get_json(silent=True) or {}
+    names = data.get("services")
+    services, graph = registry_snapshot()
+
+    if names == "all":
+        selected = list(services)
+    elif isinstance(names, list) and names and all(isinstance(name, str) for name in names):
+        by_name = {service['name']: service for service in services}
+        unknown = [name for name in names if name not in by_name]
+        if unknown:
+            return jsonify({"error": "Service not found", "services": unknown}), 404
+        selected = [by_name[name] for name in dict.fromkeys(names)]
+    else:
+        return jsonify({"error": 'services must be a list of service names or "all"'}), 400
+
+    futures = start_checks(selected, graph)
+    if data.get("stream"):
+        names_by_future = {future: name for name, future in futures.items()}
+
+        def generate():
+            for future in as_completed(names_by_future):
+                yield json.dumps(check_outcome(names_by_future[future], future)) + "\n"
+        return Response(generate(), mimetype="application/x-ndjson")
+
+    results = [check_outcome(service['name'], futures[service['name']]) for service in selected]
+    return jsonify({"results": results}), 200
+
+def beat():
+    monitor_state["heartbeat"] = time.time()
+
+# Probe the given services, dependencies first. Full GETs go one at a time, cheap probe
+# types of the same level share the multiplexer. Dependents of a down service are only
+# probed every SUPPRESSED_PROBE_EVERY sweeps, and a recovered service's subtree is re-probed at once.
+def run_sweep(services, graph=None):
+    graph = graph or dependency_graph
+    # Root-cause alerts describe the same graph the sweep ordered and suppressed by
+    sweep_services(services, graph, suppressed_sweeps, SUPPRESSED_PROBE_EVERY,
+                   check=lambda service: check_service_health(service, graph),
+                   check_batch=lambda batch: check_services_batch(batch, graph),
+                   probe_suppressed=probe_suppressed,
+                   is_batched=is_batched,
+                   heartbeat=beat)
+
+# One pass of the monitor loop: apply a pending refresh, then sweep every service
+def monitor_iteration():
+    global refresh_flag
+    monitor_state["sweep_started"] = time.time()
+    monitor_state["heartbeat"] = monitor_state["sweep_started"]
+    if refresh_flag:
+        # Clear the flag before reloading so a /refresh that arrives meanwhile isn't lost
+        refresh_flag = False
+        mongo_logger.info("Refreshing microservices list...")
+        try:
+            load_registry()
+        except Exception:
+            refresh_flag = True
+            raise
+        mongo_logger.info("Microservices list refreshed.")
+
+    services, graph = registry_snapshot()
+    run_sweep(services, graph)
+
+    finished = time.time()
+    duration = finished - monitor_state["sweep_started"]
+    if duration > SWEEP_DEADLINE:
+        mongo_logger.warning(f"Sweep took {duration:.1f}s, over the {SWEEP_DEADLINE}s deadline")
+    monitor_state["last_success"] = finished
+    monitor_state["sweep_started"] = None
+
+# The probe loop itself. Exceptions propagate to supervise_monitor, which restarts it.
+def monitor_services():
+    while True:
+        monitor_iteration()
+        time.sleep(SLEEP_TIME)
+
+# Keep monitor_services running, restarting it with exponential backoff when it crashes
+def supervise_monitor():
+    backoff = RESTART_BACKOFF_MIN
+    while True:
+        started = time.time()
+        try:
+            monitor_services()
+        except Exception as e:
+            # A loop that got through a sweep since the last crash starts over with a short backoff
+            if monitor_state["last_success"] and monitor_state["last_success"] >= started:
+                backoff = RESTART_BACKOFF_MIN
+            monitor_state["sweep_started"] = None
+            monitor_state["last_error"] = f"{type(e).__name__}: {e}"
+            monitor_state["restarts"] += 1
+            mongo_logger.error(f"Error in monitoring services, restarting in {backoff:.0f}s: {e}")
+        time.sleep(backoff)
+        backoff = min(backoff * 2, RESTART_BACKOFF_MAX)
 
 def main():
-    service_monitoring_thread = threading.Thread(target=monitor_services)
+    service_monitoring_thread = threading.Thread(target=supervise_monitor)
     service_monitoring_thread.daemon = True  # Make thread daemon so it exits when main thread exits
     service_monitoring_thread.start()
 
@@ -0,0 +1,481 @@
+import errno
+import json
+import os
+import re
+import selectors
+import socket
+import ssl
+import threading
+import time
+from concurrent.futures import Future
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Probe limits, all overridable through the environment
+PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT", 5))           # socket connect/read timeout (seconds)
+PROBE_DEADLINE = float(os.getenv("PROBE_DEADLINE", 10))        # total budget for one probe (seconds)
+PROBE_MAX_BYTES = int(os.getenv("PROBE_MAX_BYTES", 64 * 1024)) # most of the body we will ever read
+PROBE_CHUNK_SIZE = 4096
+
+# Compiled content assertions, keyed by service name
+_assertion_cache = {}
+
+# Turn an "expect" spec from a Watchdog_microservices document into a checker
+#   {"json_field": "status", "equals": "alive"}  -> dotted path into the JSON body
+#   {"regex": "ok|alive"}                        -> searched in the decoded body
+def compile_assertion(spec):
+    if not spec:
+        return None
+    if "regex" in spec:
+        pattern = re.compile(spec["regex"])
+
+        def check(body):
+            text = body.decode("utf-8", errors="replace")
+            if pattern.search(text):
+                return True, None
+            return False, f"body did not match /{pattern.pattern}/"
+        return check
+    if "json_field" in spec:
+        path = spec["json_field"].split(".")
+        expected = spec.get("equals")
+
+        def check(body):
+            try:
+                value = json.loads(body)
+                for key in path:
+                    value = value[key]
+            except (ValueError, KeyError, IndexError, TypeError):
+                return False, f"JSON field {spec['json_field']} missing"
+            if value == expected:
+                return True, None
+            return False, f"JSON field {spec['json_field']} was {value!r}, expected {expected!r}"
+        return check
+    raise ValueError(f"Unsupported expect spec: {spec}")
+
+# Compile the assertions of every service once, replacing the previous cache
+def compile_assertions(services):
+    global _assertion_cache
+    cache = {}
+    for service in services:
+        try:
+            cache[service["name"]] = compile_assertion(service.get("expect"))
+        except (ValueError, re.error) as e:
+            # A broken spec should not take the whole registry down with it
+            cache[service["name"]] = _invalid_assertion(str(e))
+    _assertion_cache = cache
+
+def _invalid_assertion(error):
+    def check(body):
+        return False, f"invalid expect spec: {error}"
+    return check
+
+def get_assertion(service):
+    name = service["name"]
+    if name not in _assertion_cache:
+        try:
+            _assertion_cache[name] = compile_assertion(service.get("expect"))
+        except (ValueError, re.error) as e:
+            _assertion_cache[name] = _invalid_assertion(str(e))
+    return _assertion_cache[name]
+
+class _Deadline:
+    """
+    Overall budget for one probe. Socket timeouts only bound each recv, so a peer that
+    trickles headers or body a byte at a time never trips them; when the budget runs
+    out this shuts the probe's sockets down, which wakes whatever read is blocked.
+    """
+
+    def __init__(self, seconds):
+        self.lock = threading.Lock()
+        self.sockets = []
+        self.expired = False
+        self.finished = False
+        self.timer = threading.Timer(seconds, self.expire)
+        self.timer.daemon = True
+
+    def __enter__(self):
+        _probe_local.deadline = self
+        self.timer.start()
+        return self
+
+    def __exit__(self, *exc):
+        _probe_local.deadline = None
+        self.finish()
+        for sock in self.sockets:
+            sock.close()
+
+    # Called with each new socket. A duplicate is kept because TLS wrapping detaches
+    # the original, and shutting down the duplicate shuts down the connection.
+    def track(self, sock):
+        with self.lock:
+            sock = sock.dup()
+            self.sockets.append(sock)
+            if self.expired:
+                self._shutdown(sock)
+
+    def expire(self):
+        with self.lock:
+            if self.finished:
+                return
+            self.expired = True
+            for sock in self.sockets:
+                self._shutdown(sock)
+
+    # Stop the clock. Returns True if the deadline had already passed.
+    def finish(self):
+        self.timer.cancel()
+        with self.lock:
+            self.finished = True
+            return self.expired
+
+    @staticmethod
+    def _shutdown(sock):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+_probe_local = threading.local()
+
+class _DeadlineConnectionMixin:
+    def _new_conn(self):
+        sock = super()._new_conn()
+        deadline = getattr(_probe_local, "deadline", None)
+        if deadline is not None:
+            deadline.track(sock)
+        return sock
+
+class _DeadlineHTTPConnection(_DeadlineConnectionMixin, HTTPConnection):
+    pass
+
+class _DeadlineHTTPSConnection(_DeadlineConnectionMixin, HTTPSConnection):
+    pass
+
+class _DeadlineHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _DeadlineHTTPConnection
+
+class _DeadlineHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _DeadlineHTTPSConnection
+
+class _DeadlineAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _DeadlineHTTPConnectionPool,
+            "https": _DeadlineHTTPSConnectionPool
+        }
+
+class ProbeSession(requests.Session):
+    """Session whose sockets can be cut off by the probe deadline of the calling thread."""
+
+    def __init__(self):
+        super().__init__()
+        adapter = _DeadlineAdapter()
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+# Read at most max_bytes of a streamed response, giving up once the deadline passes.
+# Returns (body, error) where error is None on success.
+def read_bounded(response, max_bytes, deadline):
+    body = bytearray()
+    try:
+        for chunk in response.iter_content(chunk_size=PROBE_CHUNK_SIZE):
+            body.extend(chunk)
+            if len(body) > max_bytes:
+                return None, f"response body exceeded {max_bytes} bytes"
+    except requests.exceptions.RequestException:
+        # A read cut short by the deadline surfaces as a protocol error
+        if not deadline.expired:
+            raise
+    if deadline.finish():
+        return None, "probe deadline exceeded while reading body"
+    return bytes(body), None
+
+# Probe a service over HTTP GET. Returns (healthy, reason); reason explains a failure.
+# Raises requests.exceptions.RequestException for connection level errors.
+def probe_http(service, timeout=None, deadline=None, max_bytes=None):
+    timeout = PROBE_TIMEOUT if timeout is None else timeout
+    deadline = PROBE_DEADLINE if deadline is None else deadline
+    max_bytes = PROBE_MAX_BYTES if max_bytes is None else max_bytes
+
+    # A fresh session per probe, like requests.get, so every socket is tracked by the deadline
+    with _Deadline(deadline) as budget, ProbeSession() as session:
+        try:
+            # Stream so that nothing beyond the headers is downloaded unless we need it
+            response = session.get(service['url'], timeout=min(timeout, deadline), stream=True)
+        except requests.exceptions.RequestException:
+            if budget.expired:
+                return False, "probe deadline exceeded while waiting for headers"
+            raise
+        try:
+            if response.status_code != 200:
+                return False, f"returned status code {response.status_code}"
+
+            assertion = get_assertion(service)
+            if assertion is None:
+                return True, None
+
+            body, error = read_bounded(response, max_bytes, budget)
+            if error:
+                return False, error
+            return assertion(body)
+        finally:
+            response.close()
+
+####################################################################################
+###################### NON-BLOCKING TCP / HEAD PROBES BELOW ########################
+####################################################################################
+# Probe types a Watchdog_microservices document can select with "probe_type"
+PROBE_HTTP_GET = "http_get"
+PROBE_HTTP_HEAD = "http_head"
+PROBE_TCP_CONNECT = "tcp_connect"
+PROBE_TYPES = (PROBE_HTTP_GET, PROBE_HTTP_HEAD, PROBE_TCP_CONNECT)
+
+# Cap on sockets open at once so a big fleet doesn't run us out of file descriptors
+PROBE_MAX_IN_FLIGHT = int(os.getenv("PROBE_MAX_IN_FLIGHT", 1024))
+STATUS_LINE_LIMIT = 1024
+# Seconds a resolved address is reused before the name is looked up again
+PROBE_DNS_TTL = float(os.getenv("PROBE_DNS_TTL", 60))
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+def get_probe_type(service):
+    return service.get("probe_type") or PROBE_HTTP_GET
+
+# Resolved addresses, keyed by (host, port), as (expires, family, sockaddr)
+_dns_cache = {}
+
+# Resolving is blocking, so answers are reused for PROBE_DNS_TTL seconds. They do expire,
+# so a service that moves to a new address is probed there rather than alerted as down.
+def _resolve(host, port, now=None):
+    now = time.monotonic() if now is None else now
+    cached = _dns_cache.get((host, port))
+    if cached is not None and cached[0] > now:
+        return cached[1], cached[2]
+    family, socktype, proto, _, sockaddr = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0]
+    _dns_cache[(host, port)] = (now + PROBE_DNS_TTL, family, sockaddr)
+    return family, sockaddr
+
+# Drop expired answers so hosts that left the registry don't stay cached
+def _prune_dns_cache(now):
+    for key in [key for key, entry in list(_dns_cache.items()) if entry[0] <= now]:
+        _dns_cache.pop(key, None)
+
+class _Target:
+    __slots__ = ("name", "kind", "host", "port", "path", "tls", "sock", "state", "expires", "outbox", "inbox")
+
+    def __init__(self, name, kind, host, port, path, tls=False):
+        self.name = name
+        self.kind = kind
+        self.host = host
+        self.port = port
+        self.path = path
+        self.tls = tls
+        self.sock = None
+        self.state = "connecting"
+        self.expires = 0.0
+        self.outbox = b""
+        self.inbox = b""
+
+def _parse_target(service):
+    url = urlsplit(service["url"])
+    port = url.port or DEFAULT_PORTS.get(url.scheme)
+    if not url.hostname or not port:
+        raise ValueError(f"cannot derive host and port from {service['url']}")
+    path = url.path or "/"
+    if url.query:
+        path += "?" + url.query
+    kind = get_probe_type(service)
+    return _Target(service["name"], kind, url.hostname, port, path,
+                   tls=kind == PROBE_HTTP_HEAD and url.scheme == "https")
+
+_tls_context = None
+
+# Verifies certificates against the same CA bundle requests uses
+def _get_tls_context():
+    global _tls_context
+    if _tls_context is None:
+        _tls_context = ssl.create_default_context(cafile=requests.certs.where())
+    return _tls_context
+
+# Probe many services with tcp_connect or http_head on one selector.
+# Returns {service name: (healthy, reason)}; it never raises for individual targets.
+def probe_batch(services, timeout=None, max_in_flight=None):
+    timeout = PROBE_TIMEOUT if timeout is None else timeout
+    max_in_flight = PROBE_MAX_IN_FLIGHT if max_in_flight is None else max_in_flight
+    results = {}
+    pending = []
+    _prune_dns_cache(time.monotonic())
+
+    for service in services:
+        kind = get_probe_type(service)
+        if kind not in (PROBE_HTTP_HEAD, PROBE_TCP_CONNECT):
+            results[service["name"]] = (False, f"unsupported probe_type {kind}")
+            continue
+        try:
+            pending.append(_parse_target(service))
+        except ValueError as e:
+            results[service["name"]] = (False, str(e))
+
+    selector = selectors.DefaultSelector()
+    in_flight = 0
+    pending.reverse()  # pop() from the end while keeping registry order
+
+    def finish(target, healthy, reason=None):
+        nonlocal in_flight
+        selector.unregister(target.sock)
+        target.sock.close()
+        in_flight -= 1
+        results[target.name] = (healthy, reason)
+
+    try:
+        while pending or in_flight:
+            # Open new connections up to the in-flight cap
+            while pending and in_flight < max_in_flight:
+                target = pending.pop()
+                try:
+                    family, sockaddr = _resolve(target.host, target.port)
+                    sock = socket.socket(family, socket.SOCK_STREAM)
+                except (OSError, UnicodeError, ValueError) as e:
+                    # A malformed hostname (e.g. "a..b") fails IDNA encoding with UnicodeError
+                    results[target.name] = (False, f"connect failed: {e}")
+                    continue
+                sock.setblocking(False)
+                err = sock.connect_ex(sockaddr)
+                if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    sock.close()
+                    results[target.name] = (False, f"connect failed: {os.strerror(err)}")
+                    continue
+                target.sock = sock
+                target.expires = time.monotonic() + timeout
+                selector.register(sock, selectors.EVENT_WRITE, target)
+                in_flight += 1
+
+            if not in_flight:
+                break
+
+            now = time.monotonic()
+            nearest = min(key.data.expires for key in selector.get_map().values())
+            for key, _ in selector.select(timeout=max(0.0, nearest - now)):
+                target = key.data
+                try:
+                    if target.state == "connecting":
+                        err = target.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                        if err:
+                            finish(target, False, f"connect failed: {os.strerror(err)}")
+                            continue
+                        if target.kind == PROBE_TCP_CONNECT:
+                            finish(target, True)
+                            continue
+                        if target.tls:
+                            # The wrapped socket replaces the plain one in the selector
+                            selector.unregister(target.sock)
+                            target.sock = _get_tls_context().wrap_socket(
+                                target.sock, server_hostname=target.host, do_handshake_on_connect=False)
+                            selector.register(target.sock, selectors.EVENT_WRITE, target)
+                            target.state = "handshaking"
+                        else:
+                            target.state = "sending"
+
+                    if target.state == "handshaking":
+                        try:
+                            target.sock.do_handshake()
+                        except ssl.SSLWantReadError:
+                            selector.modify(target.sock, selectors.EVENT_READ, target)
+                            continue
+                        except ssl.SSLWantWriteError:
+                            selector.modify(target.sock, selectors.EVENT_WRITE, target)
+                            continue
+                        except (ssl.SSLError, ssl.CertificateError) as e:
+                            finish(target, False, f"TLS handshake failed: {e}")
+                            continue
+                        target.state = "sending"
+                        selector.modify(target.sock, selectors.EVENT_WRITE, target)
+
+                    if target.state == "sending" and not target.outbox:
+                        target.outbox = (f"HEAD {target.path} HTTP/1.0\r\nHost: {target.host}\r\n"
+                                         f"Connection: close\r\n\r\n").encode()
+
+                    if target.state == "sending":
+                        sent = target.sock.send(target.outbox)
+                        target.outbox = target.outbox[sent:]
+                        if not target.outbox:
+                            target.state = "reading"
+                            selector.modify(target.sock, selectors.EVENT_READ, target)
+                        continue
+
+                    chunk = target.sock.recv(STATUS_LINE_LIMIT)
+                except (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                    continue
+                except OSError as e:
+                    finish(target, False, f"HEAD failed: {e}")
+                    continue
+
+                # Only the status line matters, so stop as soon as we have it
+                target.inbox += chunk
+                if b"\r\n" in target.inbox or not chunk or len(target.inbox) > STATUS_LINE_LIMIT:
+                    status_line = target.inbox.split(b"\r\n", 1)[0].split()
+                    if len(status_line) < 2 or not status_line[1].isdigit():
+                        finish(target, False, "malformed HTTP status line")
+                    elif status_line[1] != b"200":
+                        finish(target, False, f"returned status code {status_line[1].decode()}")
+                    else:
+                        finish(target, True)
+
+            # Expire whatever ran out of time
+            now = time.monotonic()
+            for key in list(selector.get_map().values()):
+                if key.data.expires <= now:
+                    finish(key.data, False, f"timed out after {timeout}s")
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+
+    return results
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent probes of the same service: the first caller to claim a
+    service owns its probe, and everyone asking while it is in flight waits on the
+    same Future instead of probing the target again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.stats = {"probes": 0, "coalesced": 0}
+
+    # Returns ({name: Future}, owned). The caller must probe every service in `owned`
+    # and resolve it; the rest are already being probed by someone else.
+    def claim(self, services):
+        futures = {}
+        owned = []
+        with self.lock:
+            for service in services:
+                future = self.in_flight.get(service['name'])
+                if future is None:
+                    future = self.in_flight[service['name']] = Future()
+                    owned.append(service)
+                    self.stats["probes"] += 1
+                else:
+                    self.stats["coalesced"] += 1
+                futures[service['name']] = future
+        return futures, owned
+
+    # Publish the outcome of an owned probe. The service is released first, so the
+    # next caller gets a new probe rather than this result.
+    def resolve(self, name, result=None, error=None):
+        with self.lock:
+            future = self.in_flight.pop(name)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, in_flight=len(self.in_flight))
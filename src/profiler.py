@@ -0,0 +1,100 @@
+import hmac
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from flask import Blueprint, Response, request, jsonify
+
+# Debug endpoints are off unless explicitly enabled, and always need the token
+DEBUG_ENDPOINTS_ENABLED = os.getenv("DEBUG_ENDPOINTS_ENABLED", "false").lower() == "true"
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")
+
+# Bounds that keep the sampler cheap: at most 100 samples per second, for at most a minute
+PROFILE_INTERVAL = max(float(os.getenv("PROFILE_INTERVAL", 0.01)), 0.01)
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 60))
+PROFILE_MAX_DEPTH = 128
+
+# Only one profile runs at a time
+_profile_lock = threading.Lock()
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def _collapse(frame):
+    stack = []
+    while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+        stack.append(_frame_label(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+# Sample the stacks of every other thread for `seconds` and aggregate them in
+# collapsed-stack format ("thread;outer;...;inner count" per line) for flamegraph tools
+def sample_stacks(seconds, interval=PROFILE_INTERVAL):
+    me = threading.get_ident()
+    counts = Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            thread = names.get(ident, f"thread-{ident}").replace(";", "_")
+            counts[";".join([thread] + _collapse(frame))] += 1
+        samples += 1
+        time.sleep(interval)
+    lines = [f"{stack} {count}" for stack, count in counts.most_common()]
+    return "\n".join(lines) + "\n", samples
+
+def dump_threads():
+    frames = sys._current_frames()
+    out = []
+    for thread in threading.enumerate():
+        out.append(f"Thread {thread.name} (ident={thread.ident}, daemon={thread.daemon})")
+        frame = frames.get(thread.ident)
+        if frame is not None:
+            out.extend(line.rstrip("\n") for line in traceback.format_stack(frame))
+        out.append("")
+    return "\n".join(out) + "\n"
+
+def _authorized():
+    supplied = request.headers.get("X-Debug-Token")
+    auth = request.headers.get("Authorization", "")
+    if supplied is None and auth.startswith("Bearer "):
+        supplied = auth[len("Bearer "):]
+    return bool(DEBUG_TOKEN) and supplied is not None and hmac.compare_digest(supplied, DEBUG_TOKEN)
+
+debug_blueprint = Blueprint("debug", __name__, url_prefix="/debug")
+
+@debug_blueprint.before_request
+def check_debug_access():
+    # Pretend the endpoints don't exist when they are switched off
+    if not DEBUG_ENDPOINTS_ENABLED:
+        return jsonify({"error": "Not found"}), 404
+    if not _authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+
+@debug_blueprint.route('/profile')
+def profile():
+    try:
+        seconds = float(request.args.get("seconds", 5))
+    except ValueError:
+        return jsonify({"error": "seconds must be a number"}), 400
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        return jsonify({"error": f"seconds must be between 0 and {PROFILE_MAX_SECONDS}"}), 400
+
+    if not _profile_lock.acquire(blocking=False):
+        return jsonify({"error": "A profile is already running"}), 409
+    try:
+        collapsed, samples = sample_stacks(seconds)
+    finally:
+        _profile_lock.release()
+    return Response(collapsed, mimetype="text/plain", headers={"X-Profile-Samples": str(samples)})
+
+@debug_blueprint.route('/threads')
+def threads():
+    return Response(dump_threads(), mimetype="text/plain")
@@ -0,0 +1,346 @@
+"""
+Offline replay of the alerting state machine.
+
+Feeds recorded probe outcomes (the `logs` collection or a JSONL file) or a synthetic
+outage scenario through the same transition, dependency and mail queue logic the
+primary watchdog uses, on a virtual clock, and reports which alerts would have gone
+out, when, and what they would have cost in Mongo writes and SMTP transactions.
+
+    python src/replay.py --jsonl outcomes.jsonl --registry registry.json --interval 300 60
+    python src/replay.py --logs --registry mongo --since 2025-03-01
+    python src/replay.py --scenario outage:data_collection:3600:1800 --registry registry.json --hours 4
+
+JSONL lines look like {"t": 120, "service": "data_collection", "healthy": false}
+where "t" is seconds or an ISO timestamp, with optional "latency" (seconds) and "reason".
+"""
+import argparse
+import bisect
+import itertools
+import json
+import re
+import time
+from datetime import datetime
+
+from alerting import alert_message, apply_probe_result, root_cause_message, sweep_services, transition
+from dependencies import DependencyGraph
+from emailer import MailQueue, PRIORITY_DOWN, PRIORITY_UP
+
+LOG_LINE = re.compile(r" - (?P<name>[^ ]+) is (?P<state>healthy|down)\.$")
+
+class VirtualClock:
+    def __init__(self, start=0.0):
+        self.now = float(start)
+
+    def __call__(self):
+        return self.now
+
+    def advance_to(self, t):
+        self.now = max(self.now, float(t))
+
+class CountingLogger:
+    """Stands in for the Mongo logger; every line it receives would have been one insert."""
+
+    def __init__(self):
+        self.inserts = 0
+
+    def _log(self, message):
+        self.inserts += 1
+
+    info = error = warning = debug = _log
+
+class CountingSMTP:
+    """Fake SMTP connection; each sendmail is one transaction."""
+
+    def __init__(self, report, clock):
+        self.report = report
+        self.clock = clock
+
+    def starttls(self):
+        pass
+
+    def login(self, user, password):
+        self.report["smtp_logins"] += 1
+
+    def sendmail(self, sender, recipients, message):
+        self.report["smtp_transactions"] += 1
+        self.report["smtp_recipients"] += len(recipients)
+        self.report["deliveries"].append({"t": self.clock(), "recipients": len(recipients)})
+
+    def quit(self):
+        pass
+
+####################################################################################
+################################ INPUT LOADERS #####################################
+####################################################################################
+
+def _seconds(value, epoch):
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return (value - epoch).total_seconds() if epoch else value.timestamp()
+
+# Read outcome events from a JSONL file
+def load_jsonl(path):
+    with open(path) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    timestamps = [datetime.fromisoformat(r["t"]) for r in rows if isinstance(r["t"], str)]
+    epoch = min(timestamps) if timestamps else None
+    return [{
+        "t": _seconds(row["t"], epoch),
+        "service": row["service"],
+        "healthy": bool(row["healthy"]),
+        "latency": row.get("latency"),
+        "reason": row.get("reason")
+    } for row in rows]
+
+# Rebuild outcome events from the "X is healthy." / "X is down." lines the primary logs
+def load_logs(mongo_uri=None, since=None, until=None):
+    from pymongo import MongoClient
+    from db_functions import MONGO_URI, DEFAULT_DB_NAME, DEFAULT_COLLECTION_NAME
+
+    client = MongoClient(mongo_uri or MONGO_URI)
+    try:
+        query = {}
+        if since or until:
+            query["timestamp"] = {}
+            if since:
+                query["timestamp"]["$gte"] = since
+            if until:
+                query["timestamp"]["$lt"] = until
+        cursor = client[DEFAULT_DB_NAME][DEFAULT_COLLECTION_NAME].find(
+            query, {"_id": 0, "timestamp": 1, "message": 1}).sort("timestamp", 1)
+        events = []
+        epoch = None
+        for doc in cursor:
+            match = LOG_LINE.search(doc.get("message", ""))
+            if not match:
+                continue
+            epoch = epoch or doc["timestamp"]
+            events.append({
+                "t": (doc["timestamp"] - epoch).total_seconds(),
+                "service": match.group("name"),
+                "healthy": match.group("state") == "healthy",
+                "latency": None,
+                "reason": None
+            })
+        return events
+    finally:
+        client.close()
+
+# Registry documents from a JSON file (a list of Watchdog_microservices documents) or Mongo
+def load_registry(source, mongo_uri=None):
+    if source == "mongo":
+        from db_functions import get_all_microservices
+        return [record.to_dict() for record in get_all_microservices(mongo_uri)]
+    with open(source) as f:
+        return json.load(f)
+
+# Synthetic scenarios, e.g. "outage:data_collection:3600:1800" (down from t=3600 for 30 min)
+# or "flap:data_analytics:600:3600:120" (flipping every 120 s for an hour from t=600)
+def scenario_events(spec):
+    kind, name, *args = spec.split(":")
+    if kind == "outage":
+        start, duration = (float(a) for a in args)
+        return [{"t": start, "service": name, "healthy": False, "latency": None, "reason": "synthetic outage"},
+                {"t": start + duration, "service": name, "healthy": True, "latency": None, "reason": None}]
+    if kind == "flap":
+        start, duration, period = (float(a) for a in args)
+        events = []
+        t, healthy = start, False
+        while t < start + duration:
+            events.append({"t": t, "service": name, "healthy": healthy, "latency": None, "reason": "synthetic flap"})
+            t += period
+            healthy = not healthy
+        events.append({"t": start + duration, "service": name, "healthy": True, "latency": None, "reason": None})
+        return events
+    raise ValueError(f"Unknown scenario {spec}")
+
+####################################################################################
+################################## SIMULATION ######################################
+####################################################################################
+
+class Timeline:
+    """Step function of each service's recorded outcome over virtual time."""
+
+    def __init__(self, events):
+        self.times = {}
+        self.outcomes = {}
+        for event in sorted(events, key=lambda e: e["t"]):
+            self.times.setdefault(event["service"], []).append(event["t"])
+            self.outcomes.setdefault(event["service"], []).append(event)
+
+    @property
+    def end(self):
+        return max((times[-1] for times in self.times.values()), default=0.0)
+
+    # Outcome of probing `name` at time t with the given timeout. Services are up until
+    # their first recorded event, and a recorded latency over the timeout counts as down.
+    def outcome_at(self, name, t, timeout):
+        times = self.times.get(name)
+        if not times:
+            return True, None
+        index = bisect.bisect_right(times, t) - 1
+        if index < 0:
+            return True, None
+        event = self.outcomes[name][index]
+        if event["latency"] is not None and event["latency"] > timeout:
+            return False, f"timed out after {timeout}s"
+        if event["healthy"]:
+            return True, None
+        return False, event["reason"] or "recorded as down"
+
+# Replay `events` against `registry` with one combination of settings and report the cost
+def simulate(registry, events, interval=300, timeout=5, suppress_every=5, horizon=None,
+             sender_rate=None, sender_burst=None, domain_rate=None, domain_burst=None):
+    started = time.perf_counter()
+    timeline = Timeline(events)
+    horizon = timeline.end + interval if horizon is None else horizon
+
+    # Fresh copies, since the state machine updates prev_status in place
+    services = [dict(doc, prev_status=doc.get("prev_status", True), recipients=list(doc.get("recipients", ())))
+                for doc in registry]
+    known = {s["name"] for s in services}
+    for name in timeline.times:
+        if name not in known:
+            services.append({"name": name, "url": "", "recipients": [], "prev_status": True})
+    graph = DependencyGraph(services)
+
+    clock = VirtualClock()
+    logger = CountingLogger()
+    report = {
+        "settings": {"interval": interval, "timeout": timeout, "suppress_every": suppress_every},
+        "sweeps": 0, "probes": 0, "status_writes": 0, "log_inserts": 0,
+        "alerts": [], "deliveries": [],
+        "smtp_logins": 0, "smtp_transactions": 0, "smtp_recipients": 0
+    }
+    mail = MailQueue(sender_email="watchdog@replay", sender_password="", clock=clock,
+                     smtp_factory=lambda: CountingSMTP(report, clock), logger=logger,
+                     sender_rate=sender_rate, sender_burst=sender_burst,
+                     domain_rate=domain_rate, domain_burst=domain_burst)
+
+    def send_alert(service_name, recipients, alert_type="down"):
+        subject, body = alert_message(service_name, alert_type)
+        report["alerts"].append({"t": clock(), "service": service_name, "type": alert_type,
+                                 "root_cause": False, "recipients": len(recipients)})
+        logger.inserts += 1  # "Alert queued for ..." log line
+        if recipients:
+            mail.enqueue(subject, body, list(recipients), topic=service_name,
+                         priority=PRIORITY_DOWN if alert_type == "down" else PRIORITY_UP)
+
+    def persist_status(service_name, status):
+        report["status_writes"] += 1
+
+    def check(service):
+        report["probes"] += 1
+        healthy, reason = timeline.outcome_at(service["name"], clock(), timeout)
+        prev_status = apply_probe_result(service, healthy, reason, send_alert=send_alert,
+                                         persist_status=persist_status, logger=logger)
+        alert_type = transition(prev_status, healthy)
+        if alert_type is not None:
+            send_root_cause_alert(service, alert_type)
+
+    def check_batch(batch):
+        for service in batch:
+            check(service)
+
+    def probe_suppressed(batch, blockers):
+        report["probes"] += len(batch)
+        logger.inserts += len(batch)
+
+    def send_root_cause_alert(service, alert_type):
+        message = root_cause_message(graph, service, alert_type)
+        if message is None:
+            return
+        subject, body, recipients = message
+        report["alerts"].append({"t": clock(), "service": service["name"], "type": alert_type,
+                                 "root_cause": True, "recipients": len(recipients)})
+        logger.inserts += 1
+        mail.enqueue(subject, body, recipients, topic=service["name"],
+                     priority=PRIORITY_DOWN if alert_type == "down" else PRIORITY_UP)
+
+    suppressed_sweeps = {}
+    t = 0.0
+    while t <= horizon:
+        clock.advance_to(t)
+        sweep_services(services, graph, suppressed_sweeps, suppress_every,
+                       check=check, check_batch=check_batch, probe_suppressed=probe_suppressed,
+                       is_batched=lambda service: False)
+        report["sweeps"] += 1
+        # Let the mail queue work through whatever became sendable before the next sweep
+        while True:
+            wait = mail.run_once()
+            if wait is None or clock() + wait >= t + interval:
+                break
+            clock.advance_to(clock() + wait)
+        t += interval
+
+    # Drain whatever is still throttled after the last sweep
+    while True:
+        wait = mail.run_once()
+        if wait is None:
+            break
+        clock.advance_to(clock() + wait)
+
+    report["log_inserts"] = logger.inserts
+    report["mongo_writes"] = report["status_writes"] + report["log_inserts"]
+    report["throttled"] = mail.get_stats()["throttled"]
+    report["virtual_seconds"] = horizon
+    report["wall_seconds"] = time.perf_counter() - started
+    report["speedup"] = horizon / report["wall_seconds"] if report["wall_seconds"] else None
+    return report
+
+def print_report(report, show_alerts=True):
+    settings = report["settings"]
+    print(f"interval={settings['interval']}s timeout={settings['timeout']}s "
+          f"suppress_every={settings['suppress_every']}: {report['sweeps']} sweeps, "
+          f"{report['probes']} probes, {len(report['alerts'])} alerts, "
+          f"{report['mongo_writes']} Mongo writes ({report['status_writes']} status, {report['log_inserts']} log), "
+          f"{report['smtp_transactions']} SMTP sends to {report['smtp_recipients']} recipients, "
+          f"{report['throttled']} throttle events, {report['speedup']:.0f}x real time")
+    if show_alerts:
+        for alert in report["alerts"]:
+            kind = "root cause" if alert["root_cause"] else "alert"
+            print(f"  t={alert['t']:>9.0f}s  {kind:<10} {alert['service']} is {alert['type']} "
+                  f"({alert['recipients']} recipients)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay probe outcomes through the watchdog alerting logic.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--jsonl", help="file of recorded probe outcomes")
+    source.add_argument("--logs", action="store_true", help="read outcomes from the Mongo logs collection")
+    source.add_argument("--scenario", action="append", help="synthetic scenario, may be repeated")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="with --logs, first timestamp to replay")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="with --logs, timestamp to stop at")
+    parser.add_argument("--registry", help="JSON list of service documents, or 'mongo'")
+    parser.add_argument("--mongo-uri")
+    parser.add_argument("--hours", type=float, help="length of the replay, defaults to the last event")
+    parser.add_argument("--interval", type=float, nargs="+", default=[300], help="sweep interval(s) to compare")
+    parser.add_argument("--timeout", type=float, nargs="+", default=[5], help="probe timeout(s) to compare")
+    parser.add_argument("--suppress-every", type=int, nargs="+", default=[5])
+    parser.add_argument("--quiet", action="store_true", help="only print the summary lines")
+    parser.add_argument("--json", help="also write the full reports to this file")
+    args = parser.parse_args()
+
+    if args.jsonl:
+        events = load_jsonl(args.jsonl)
+    elif args.logs:
+        events = load_logs(args.mongo_uri, args.since, args.until)
+    else:
+        events = [event for spec in args.scenario for event in scenario_events(spec)]
+    registry = load_registry(args.registry, args.mongo_uri) if args.registry else []
+    horizon = args.hours * 3600 if args.hours else None
+
+    reports = []
+    for interval, timeout, suppress_every in itertools.product(args.interval, args.timeout, args.suppress_every):
+        report = simulate(registry, events, interval=interval, timeout=timeout,
+                          suppress_every=suppress_every, horizon=horizon)
+        print_report(report, show_alerts=not args.quiet)
+        reports.append(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,12 @@ import threading
 import time
 import requests
 import logging
+import os
 from flask import Flask, jsonify
-from emailer import send_email
+from emailer import send_email, PRIORITY_DOWN, PRIORITY_UP
+from probes import probe_http
+from profiler import debug_blueprint
+from db_functions import ProbeCache
 
 # Set up logging to log alerts and monitoring information
 logging.basicConfig(
@@ -17,6 +21,8 @@ logging.basicConfig(
 
 # Initialize the Flask app for the secondary watchdog
 app = Flask(__name__)
+# /debug/profile and /debug/threads, disabled unless DEBUG_ENDPOINTS_ENABLED is set
+app.register_blueprint(debug_blueprint)
 
 primary_watchdog_status = True  # Track the primary watchdog's status
 
@@ -31,38 +37,53 @@ microservices = [
 # Flag to control whether microservices should be monitored
 monitoring_active = False
 
+# Probe results younger than this many seconds are shared with the primary watchdog
+# through Mongo, so both don't probe the same service during a takeover (0 disables)
+PROBE_CACHE_TTL = float(os.getenv("PROBE_CACHE_TTL", 0))
+probe_cache = ProbeCache(PROBE_CACHE_TTL, source="secondary") if PROBE_CACHE_TTL > 0 else None
+
 # Sends an email alert for microservice status changes
 def send_alert(service_name, recipients, alert_type="down"):
     subject = f"ALERT: {service_name} is {alert_type}!"
     body = f"The microservice {service_name} is {alert_type}. Please check the service."
-    send_email(subject, body, recipients)
+    priority = PRIORITY_DOWN if alert_type == "down" else PRIORITY_UP
+    send_email(subject, body, recipients, priority=priority, topic=service_name)
 
-# Check health of a single microservice
-def check_service_health(service):
+# Run the HTTP GET probe for a service, unless a peer probed it recently.
+# Failures are shared through the cache too, the same way the primary does it.
+def probe_service(service):
+    cached = probe_cache.get(service) if probe_cache is not None else None
+    if cached is not None:
+        return cached
     try:
-        response = requests.get(service['url'], timeout=5)
-        if response.status_code == 200:
-            if service['prev_status'] == False:  # Microservice is back up
-                logging.info(f"{service['name']} is back up.")
-                send_alert(service['name'], service['recipients'], alert_type="up")
-            service['prev_status'] = True
-            logging.info(f"{service['name']} is healthy.")
-        else:
-            if service['prev_status'] == True:  # Microservice is down
-                logging.error(f"{service['name']} returned status code {response.status_code}")
-                send_alert(service['name'], service['recipients'], alert_type="down")
-            service['prev_status'] = False
+        result = probe_http(service)
     except requests.exceptions.RequestException as e:
+        result = (False, f"unreachable: {e}")
+    if probe_cache is not None:
+        probe_cache.put(service, *result)
+    return result
+
+# Check health of a single microservice
+def check_service_health(service):
+    healthy, reason = probe_service(service)
+    if healthy:
+        if service['prev_status'] == False:  # Microservice is back up
+            logging.info(f"{service['name']} is back up.")
+            send_alert(service['name'], service['recipients'], alert_type="up")
+        service['prev_status'] = True
+        logging.info(f"{service['name']} is healthy.")
+    else:
         if service['prev_status'] == True:  # Microservice is down
-            logging.error(f"Error while checking {service['name']}: {e}")
+            logging.error(f"{service['name']} {reason}")
             send_alert(service['name'], service['recipients'], alert_type="down")
         service['prev_status'] = False
 
 # Monitor the primary watchdog's health
 def monitor_primary_watchdog():
     global primary_watchdog_status
-    try:
-        while True:
+    while True:
+        try:
+            # The primary answers non-200 when its monitor loop has stalled, which counts as down
             response = requests.get('http://localhost:8080/status', timeout=5)
             if response.status_code == 200:
                 logging.info("Primary Watchdog is alive.")
@@ -70,21 +91,19 @@ def monitor_primary_watchdog():
                     logging.info("Primary Watchdog is back up.")
                     primary_watchdog_status = True  # Primary watchdog is back online
                     stop_monitoring_services()  # Stop monitoring microservices
-                time.sleep(30)  # Check every 30 seconds
             else:
                 logging.error("Primary Watchdog is down.")
                 if primary_watchdog_status:
                     logging.info("Taking over responsibilities from Primary Watchdog.")
                     primary_watchdog_status = False  # Mark primary as down
                     start_monitoring_services()  # Start monitoring microservices
-                time.sleep(30)  # Check again in 30 seconds
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Failed to reach primary watchdog: {e}")
-        if primary_watchdog_status:
-            logging.info("Taking over responsibilities from Primary Watchdog.")
-            primary_watchdog_status = False  # Mark primary as down
-            start_monitoring_services()  # Start monitoring microservices
-        time.sleep(30)  # Try again in 30 seconds
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Failed to reach primary watchdog: {e}")
+            if primary_watchdog_status:
+                logging.info("Taking over responsibilities from Primary Watchdog.")
+                primary_watchdog_status = False  # Mark primary as down
+                start_monitoring_services()  # Start monitoring microservices
+        time.sleep(30)  # Check again in 30 seconds
 
 # Start threads to monitor the microservices
 def start_monitoring_services():
@@ -0,0 +1,200 @@
+import unittest
+from unittest.mock import patch
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import db_functions  # The module we're testing
+
+class TestServiceRegistryLoader(unittest.TestCase):
+    def setUp(self):
+        self.docs = [
+            {"name": "service1", "url": "http://example.com/service1/status",
+             "recipients": ["test1@example.com", "test2@example.com"], "prev_status": True},
+            {"name": "service2", "url": "http://example.com/service2/status",
+             "recipients": ["test1@example.com", "test2@example.com"], "prev_status": False,
+             "probe_type": "tcp_connect"},
+        ]
+
+    @patch('db_functions.MongoClient')
+    def test_get_all_microservices_projects_and_batches(self, mock_client):
+        # Arrange
+        collection = mock_client.return_value["Qubit"]["Watchdog_microservices"]
+        collection.find.return_value = iter(self.docs)
+
+        # Act
+        services = db_functions.get_all_microservices("mongodb://test")
+
+        # Assert
+        collection.find.assert_called_once_with({}, db_functions.SERVICE_PROJECTION,
+                                                batch_size=db_functions.LOAD_BATCH_SIZE)
+        self.assertEqual(db_functions.SERVICE_PROJECTION["_id"], 0)
+        self.assertEqual([s["name"] for s in services], ["service1", "service2"])
+        self.assertEqual(services[1]["probe_type"], "tcp_connect")
+        mock_client.return_value.close.assert_called_once()
+
+    @patch('db_functions.MongoClient')
+    def test_recipient_lists_are_shared(self, mock_client):
+        # Arrange
+        collection = mock_client.return_value["Qubit"]["Watchdog_microservices"]
+        collection.find.return_value = iter(self.docs)
+
+        # Act
+        first, second = db_functions.get_all_microservices("mongodb://test")
+
+        # Assert
+        self.assertIs(first["recipients"], second["recipients"])
+        self.assertEqual(first["recipients"], ("test1@example.com", "test2@example.com"))
+
+    def test_service_record_behaves_like_document(self):
+        # Arrange
+        record = db_functions.make_service_record(self.docs[0])
+
+        # Act
+        record["prev_status"] = False
+
+        # Assert
+        self.assertEqual(record["name"], "service1")
+        self.assertIs(record.get("prev_status"), False)
+        self.assertIsNone(record.get("probe_type"))
+        self.assertEqual(record.get("missing", "default"), "default")
+        self.assertIn("test1@example.com", record["recipients"])
+        with self.assertRaises(KeyError):
+            record["_id"]
+        self.assertFalse(hasattr(record, "__dict__"))
+
+    @patch('db_functions.MongoClient')
+    def test_malformed_list_fields_do_not_abort_loading(self, mock_client):
+        # Arrange
+        collection = mock_client.return_value["Qubit"]["Watchdog_microservices"]
+        collection.find.return_value = iter([
+            {"name": "service1", "url": "http://example.com/service1/status",
+             "recipients": None, "depends_on": None, "probe_type": None},
+            {"name": "service2", "url": "http://example.com/service2/status",
+             "recipients": ["test1@example.com", None, 42], "depends_on": ["service1", {"name": "x"}],
+             "probe_type": 7},
+        ])
+
+        # Act
+        first, second = db_functions.get_all_microservices("mongodb://test")
+
+        # Assert
+        self.assertEqual(first["recipients"], ())
+        self.assertEqual(first["depends_on"], ())
+        self.assertEqual(second["recipients"], ("test1@example.com",))
+        self.assertEqual(second["depends_on"], ("service1",))
+        self.assertIsNone(second["probe_type"])
+
+    @patch('db_functions.MongoClient')
+    def test_ensure_indexes(self, mock_client):
+        # Act
+        db_functions.ensure_indexes("mongodb://test")
+
+        # Assert
+        collection = mock_client.return_value["Qubit"]["Watchdog_microservices"]
+        collection.create_index.assert_any_call("name")
+        collection.create_index.assert_any_call("recipients")
+
+class TestProbeCache(unittest.TestCase):
+    def setUp(self):
+        patcher = patch('db_functions.MongoClient')
+        self.mock_client = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.collection = self.mock_client.return_value["Qubit"]["probe_cache"]
+        self.cache = db_functions.ProbeCache(15, source="primary", mongo_uri="mongodb://test")
+        self.service = {"name": "service1", "url": "http://example.com/service1/status"}
+
+    def test_ensure_index_expires_results(self):
+        # Act
+        self.cache.ensure_index()
+
+        # Assert
+        self.collection.create_index.assert_called_once_with("expires_at", expireAfterSeconds=0)
+
+    def test_get_many_returns_fresh_results_for_matching_probes(self):
+        # Arrange
+        other = {"name": "service2", "url": "http://example.com/service2/status"}
+        moved = {"name": "service3", "url": "http://example.com/service3/status"}
+        asserted = {"name": "service4", "url": "http://example.com/service4/status",
+                    "expect": {"json_field": "status", "equals": "alive"}}
+        retyped = {"name": "service5", "url": "http://example.com/service5/status", "probe_type": "http_get"}
+        plain = {"url": None, "probe_type": "http_get", "expect_hash": None}
+        self.collection.find.return_value = iter([
+            dict(plain, _id="service1", url=self.service["url"], healthy=False, reason="returned status code 503"),
+            dict(plain, _id="service3", url="http://old.example.com/status", healthy=True, reason=None),
+            # Cached by a watchdog that probes without the content assertion
+            dict(plain, _id="service4", url=asserted["url"], healthy=True, reason=None),
+            dict(plain, _id="service5", url=retyped["url"], probe_type="tcp_connect", healthy=True, reason=None),
+        ])
+
+        # Act
+        results = self.cache.get_many([self.service, other, moved, asserted, retyped])
+
+        # Assert
+        self.assertEqual(results, {"service1": (False, "returned status code 503")})
+        query = self.collection.find.call_args[0][0]
+        self.assertEqual(sorted(query["_id"]["$in"]), ["service1", "service2", "service3", "service4", "service5"])
+        self.assertIn("$gt", query["expires_at"])
+        self.assertEqual(query["source"], {"$ne": "primary"})
+        self.assertEqual(self.cache.get_stats()["hits"], 1)
+        self.assertEqual(self.cache.get_stats()["misses"], 4)
+
+    def test_get_many_skips_results_stored_by_the_same_source(self):
+        # Arrange
+        secondary = db_functions.ProbeCache(15, source="secondary", mongo_uri="mongodb://test")
+        self.collection.find.return_value = iter([])
+
+        # Act
+        self.cache.get_many([self.service])
+        secondary.get_many([self.service])
+
+        # Assert
+        primary_query = self.collection.find.call_args_list[0][0][0]
+        secondary_query = self.collection.find.call_args_list[1][0][0]
+        self.assertEqual(primary_query["source"], {"$ne": "primary"})
+        self.assertEqual(secondary_query["source"], {"$ne": "secondary"})
+
+    def test_probe_signature_ignores_expect_key_order(self):
+        # Act
+        first = db_functions.probe_signature({"url": "u", "expect": {"json_field": "a", "equals": 1}})
+        second = db_functions.probe_signature({"url": "u", "expect": {"equals": 1, "json_field": "a"}})
+        different = db_functions.probe_signature({"url": "u", "expect": {"json_field": "a", "equals": 2}})
+
+        # Assert
+        self.assertEqual(first, second)
+        self.assertNotEqual(first["expect_hash"], different["expect_hash"])
+        self.assertEqual(first["probe_type"], "http_get")
+
+    @patch('db_functions.UpdateOne')
+    def test_put_many_upserts_in_one_bulk_write(self, mock_update_one):
+        # Act
+        self.cache.put_many([(self.service, True, None)])
+
+        # Assert
+        self.collection.bulk_write.assert_called_once_with([mock_update_one.return_value], ordered=False)
+        (selector, update), kwargs = mock_update_one.call_args
+        self.assertEqual(selector, {"_id": "service1"})
+        self.assertTrue(kwargs["upsert"])
+        stored = update["$set"]
+        self.assertEqual(stored["url"], self.service["url"])
+        self.assertEqual(stored["probe_type"], "http_get")
+        self.assertIsNone(stored["expect_hash"])
+        self.assertEqual(stored["source"], "primary")
+        self.assertEqual(self.cache.get_stats()["stores"], 1)
+
+    def test_mongo_errors_count_as_misses(self):
+        # Arrange
+        self.collection.find.side_effect = db_functions.PyMongoError("down")
+        self.collection.bulk_write.side_effect = db_functions.PyMongoError("down")
+
+        # Act
+        result = self.cache.get(self.service)
+        self.cache.put(self.service, True)
+
+        # Assert
+        self.assertIsNone(result)
+        self.assertEqual(self.cache.get_stats()["misses"], 1)
+        self.assertEqual(self.cache.get_stats()["errors"], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from dependencies import DependencyGraph  # The module we're testing
+
+class TestDependencyGraph(unittest.TestCase):
+    def setUp(self):
+        self.services = [
+            {"name": "mongo", "recipients": ["dba@example.com"], "prev_status": True},
+            {"name": "data_collection", "depends_on": ["mongo"], "recipients": ["a@example.com"], "prev_status": True},
+            {"name": "data_retrival", "depends_on": ["data_collection", "mongo"],
+             "recipients": ["a@example.com", "b@example.com"], "prev_status": True},
+            {"name": "data_analytics", "depends_on": ["data_collection"], "recipients": ["c@example.com"], "prev_status": True},
+        ]
+
+    def test_levels_put_dependencies_first(self):
+        # Act
+        graph = DependencyGraph(self.services)
+        levels = graph.group_by_level(self.services)
+
+        # Assert
+        self.assertEqual([s["name"] for s in levels[0]], ["mongo"])
+        self.assertEqual([s["name"] for s in levels[1]], ["data_collection"])
+        self.assertEqual(sorted(s["name"] for s in levels[2]), ["data_analytics", "data_retrival"])
+
+    def test_down_ancestors_and_subtree(self):
+        # Arrange
+        graph = DependencyGraph(self.services)
+        self.services[1]["prev_status"] = False  # data_collection is down
+
+        # Act / Assert
+        self.assertEqual(graph.down_ancestors("data_analytics"), ["data_collection"])
+        self.assertEqual(graph.down_ancestors("data_collection"), [])
+        self.assertEqual(sorted(graph.descendants("data_collection")), ["data_analytics", "data_retrival"])
+        self.assertEqual(graph.subtree_recipients("data_collection"), ["b@example.com", "c@example.com"])
+
+    def test_cycles_and_unknown_dependencies_are_dropped(self):
+        # Arrange
+        services = [
+            {"name": "a", "depends_on": ["b"]},
+            {"name": "b", "depends_on": ["a"]},
+            {"name": "c", "depends_on": ["a", "missing"]},
+        ]
+
+        # Act
+        with self.assertLogs("dependencies", level="WARNING"):
+            graph = DependencyGraph(services)
+
+        # Assert
+        self.assertEqual(graph.cycles, ["a", "b"])
+        self.assertEqual(graph.parents, {"a": [], "b": [], "c": ["a"]})
+        self.assertEqual(graph.depth["c"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
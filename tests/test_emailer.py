@@ -0,0 +1,204 @@
+import unittest
+from unittest.mock import MagicMock
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import emailer  # The module we're testing
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class TestTokenBucket(unittest.TestCase):
+    def test_bucket_refills_over_time(self):
+        # Arrange
+        clock = FakeClock()
+        bucket = emailer.TokenBucket(rate=60, capacity=2, clock=clock)  # one token per second
+
+        # Act
+        bucket.consume()
+        bucket.consume()
+        empty_wait = bucket.wait_time()
+        clock.now += 1
+        refilled_wait = bucket.wait_time()
+
+        # Assert
+        self.assertAlmostEqual(empty_wait, 1.0)
+        self.assertEqual(refilled_wait, 0.0)
+
+class TestMailQueue(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.server = MagicMock()
+        self.queue = emailer.MailQueue(sender_email="watchdog@example.com", sender_password="secret",
+                                       smtp_factory=lambda: self.server, clock=self.clock)
+
+    def sent_batches(self):
+        return [c.args[1] for c in self.server.sendmail.call_args_list]
+
+    def test_recipients_batched_per_domain(self):
+        # Act
+        self.queue.enqueue("ALERT", "down", ["a@corp.com", "b@corp.com", "c@other.org"])
+        self.queue.run_once()
+
+        # Assert
+        self.assertEqual(self.sent_batches(), [["a@corp.com", "b@corp.com"], ["c@other.org"]])
+        self.server.login.assert_called_once()  # One connection for the whole drain
+        stats = self.queue.get_stats()
+        self.assertEqual(stats["sent"], 3)
+        self.assertEqual(stats["batches"], 2)
+
+    def test_identical_queued_messages_are_merged(self):
+        # Act
+        self.queue.enqueue("ALERT", "down", ["a@corp.com"])
+        self.queue.enqueue("ALERT", "down", ["b@corp.com", "a@corp.com"])
+        self.queue.run_once()
+
+        # Assert
+        self.assertEqual(self.sent_batches(), [["a@corp.com", "b@corp.com"]])
+        self.assertEqual(self.queue.get_stats()["merged"], 1)
+
+    def test_down_alerts_sent_before_up_alerts(self):
+        # Act
+        self.queue.enqueue("UP", "up", ["a@corp.com"], priority=emailer.PRIORITY_UP)
+        self.queue.enqueue("DOWN", "down", ["a@corp.com"], priority=emailer.PRIORITY_DOWN)
+        self.queue.run_once()
+
+        # Assert
+        subjects = [c.args[2] for c in self.server.sendmail.call_args_list]
+        self.assertIn("Subject: DOWN", subjects[0])
+        self.assertIn("Subject: UP", subjects[1])
+
+    def test_throttled_messages_stay_queued(self):
+        # Arrange
+        burst = emailer.MAIL_DOMAIN_BURST
+        for i in range(burst + 1):
+            self.queue.enqueue(f"ALERT {i}", "down", ["a@corp.com"])
+
+        # Act
+        wait = self.queue.run_once()
+
+        # Assert
+        self.assertEqual(self.server.sendmail.call_count, burst)
+        self.assertGreater(wait, 0)
+        stats = self.queue.get_stats()
+        self.assertEqual(stats["delayed"], 1)
+        self.assertGreaterEqual(stats["throttled"], 1)
+
+        # Once the bucket refills the held message goes out
+        self.clock.now += wait
+        self.queue.run_once()
+        self.assertEqual(self.server.sendmail.call_count, burst + 1)
+        self.assertEqual(self.queue.depth(), 0)
+
+    def test_failed_send_is_retried(self):
+        # Arrange
+        self.server.sendmail.side_effect = [Exception("421 try later"), None]
+        self.queue.enqueue("ALERT", "down", ["a@corp.com"])
+
+        # Act
+        self.queue.run_once()
+        self.clock.now += emailer.MAIL_RETRY_DELAY
+        self.queue.run_once()
+
+        # Assert
+        self.assertEqual(self.server.sendmail.call_count, 2)
+        stats = self.queue.get_stats()
+        self.assertEqual(stats["retried"], 1)
+        self.assertEqual(stats["sent"], 1)
+
+    def test_recipients_are_not_disclosed_to_each_other(self):
+        # Arrange
+        self.queue.enqueue("ALERT", "down", ["a@corp.com", "b@corp.com"])
+
+        # Act
+        self.queue.run_once()
+
+        # Assert
+        sender, envelope, message = self.server.sendmail.call_args.args
+        self.assertEqual(envelope, ["a@corp.com", "b@corp.com"])
+        self.assertIn("To: undisclosed-recipients:;", message)
+        self.assertNotIn("a@corp.com", message)
+        self.assertNotIn("b@corp.com", message)
+
+    def test_flapping_service_alerts_keep_their_order(self):
+        # Arrange: one mail per domain at a time, so everything after the first is throttled
+        queue = emailer.MailQueue(sender_email="watchdog@example.com", sender_password="secret",
+                                  smtp_factory=lambda: self.server, clock=self.clock,
+                                  domain_rate=1, domain_burst=1)
+        queue.enqueue("other UP", "up", ["a@corp.com"], priority=emailer.PRIORITY_UP, topic="other")
+        queue.enqueue("svc DOWN", "down", ["a@corp.com"], priority=emailer.PRIORITY_DOWN, topic="svc")
+        queue.enqueue("svc UP", "up", ["a@corp.com"], priority=emailer.PRIORITY_UP, topic="svc")
+        queue.enqueue("svc DOWN", "down", ["b@corp.com"], priority=emailer.PRIORITY_DOWN, topic="svc")
+
+        # Act
+        while True:
+            wait = queue.run_once()
+            if wait is None:
+                break
+            self.clock.now += max(wait, 0.001)
+
+        # Assert: down still overtakes another service's up, but svc ends on its latest state
+        subjects = [c.args[2].split("Subject: ")[1].split("\n")[0] for c in self.server.sendmail.call_args_list]
+        self.assertEqual(subjects, ["svc DOWN", "svc UP", "svc DOWN", "other UP"])
+        self.assertEqual(self.sent_batches()[2], ["b@corp.com"])
+        self.assertEqual(queue.depth(), 0)
+
+    def test_logging_happens_outside_the_queue_lock(self):
+        # Arrange: a logger that records whether another thread could take the lock
+        queue = emailer.MailQueue(sender_email="watchdog@example.com", sender_password="secret",
+                                  smtp_factory=lambda: self.server, clock=self.clock,
+                                  domain_rate=1, domain_burst=1)
+        lock_free = []
+
+        def try_lock():
+            acquired = queue.condition.acquire(timeout=0.5)
+            if acquired:
+                queue.condition.release()
+            lock_free.append(acquired)
+
+        def check_lock(message):
+            other = threading.Thread(target=try_lock)
+            other.start()
+            other.join()
+        queue.logger = MagicMock()
+        queue.logger.warning.side_effect = check_lock
+        for name in ("a", "b", "c"):
+            queue.enqueue(f"ALERT {name}", "down", [f"{name}@corp.com"])
+
+        # Act
+        queue.run_once()
+
+        # Assert: the two throttled jobs produce one summary line, logged without the lock
+        queue.logger.warning.assert_called_once()
+        self.assertIn("corp.com", queue.logger.warning.call_args.args[0])
+        self.assertEqual(lock_free, [True])
+
+    def test_give_up_and_throttling_are_logged(self):
+        # Arrange
+        logger = MagicMock()
+        queue = emailer.MailQueue(sender_email="watchdog@example.com", sender_password="secret",
+                                  smtp_factory=lambda: self.server, clock=self.clock,
+                                  domain_rate=1, domain_burst=1, logger=logger)
+        self.server.sendmail.side_effect = Exception("550 mailbox unavailable")
+        queue.enqueue("ALERT", "down", ["a@corp.com"])
+        queue.enqueue("ALERT", "up", ["a@corp.com"])
+
+        # Act
+        for _ in range(emailer.MAIL_MAX_ATTEMPTS * 2):
+            queue.run_once()
+            self.clock.now += emailer.MAIL_RETRY_DELAY * emailer.MAIL_MAX_ATTEMPTS
+
+        # Assert
+        errors = [c.args[0] for c in logger.error.call_args_list]
+        warnings = [c.args[0] for c in logger.warning.call_args_list]
+        self.assertTrue(any(e.startswith("Giving up on email to a@corp.com") for e in errors))
+        self.assertTrue(any(w.startswith("Throttled email to corp.com") for w in warnings))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,249 @@
+import unittest
+from unittest.mock import patch
+import logging
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pymongo import MongoClient
+import requests
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+# Imported in setUpClass: importing it connects to MongoDB, which skipped runs must not need
+primary_watchdog = None  # The module we're testing
+
+# Opt in with RUN_LOAD_TESTS=true; needs the same local MongoDB as the integration tests
+RUN_LOAD_TESTS = os.getenv("RUN_LOAD_TESTS", "false").lower() == "true"
+LOAD_SERVICES = int(os.getenv("LOAD_SERVICES", 20))
+LOAD_REQUESTS = int(os.getenv("LOAD_REQUESTS", 2000))
+LOAD_CLIENTS = int(os.getenv("LOAD_CLIENTS", 32))
+OUTAGE_SERVICES = 3
+
+class FakeServices:
+    """Serves /svc-N/status for every fake microservice and counts the probes each one gets."""
+
+    def __init__(self):
+        self.down = set()
+        self.hits = Counter()
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                name = self.path.strip("/").split("/")[0]
+                with fake.lock:
+                    fake.hits[name] += 1
+                    code = 503 if name in fake.down else 200
+                self.send_response(code)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def url(self, name):
+        return f"http://127.0.0.1:{self.port}/{name}/status"
+
+    def set_down(self, names, down=True):
+        with self.lock:
+            if down:
+                self.down.update(names)
+            else:
+                self.down.difference_update(names)
+
+def percentile(latencies, pct):
+    if len(latencies) < 2:
+        return latencies[0] if latencies else 0.0
+    return statistics.quantiles(latencies, n=100)[pct - 1]
+
+@unittest.skipUnless(RUN_LOAD_TESTS, "set RUN_LOAD_TESTS=true to run the load suite")
+class TestConcurrentLoad(unittest.TestCase):
+    """
+    Runs the control API on a threaded server and the probe loop on its own thread,
+    both against a local MongoDB and fake microservices, while thousands of
+    subscribe/unsubscribe/refresh requests arrive concurrently.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        global primary_watchdog
+        import primary_watchdog
+        cls.mongo_uri = os.getenv("MONGO_URI_TEST", "mongodb://localhost:27017/Qubit")
+        cls.fake = FakeServices()
+        cls.fake.thread.start()
+        cls.names = [f"svc-{i}" for i in range(LOAD_SERVICES)]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fake.server.shutdown()
+        cls.fake.server.server_close()
+
+    def setUp(self):
+        client = MongoClient(self.mongo_uri)
+        db = client["Qubit"]
+        db["Watchdog_microservices"].drop()
+        db["logs"].drop()
+        db["Watchdog_microservices"].insert_many([
+            {"name": name, "url": self.fake.url(name), "recipients": [f"owner@{name}.test"], "prev_status": True}
+            for name in self.names
+        ])
+        client.close()
+        primary_watchdog.load_registry()
+
+        self.alerts = []
+        self.alerts_lock = threading.Lock()
+        patcher = patch('primary_watchdog.send_email', side_effect=self.record_alert)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Keep werkzeug from logging thousands of request lines
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        self.api = make_server("127.0.0.1", 0, primary_watchdog.app, threaded=True)
+        self.api_url = f"http://127.0.0.1:{self.api.server_port}"
+        threading.Thread(target=self.api.serve_forever, daemon=True).start()
+        self.addCleanup(self.api.server_close)
+        self.addCleanup(self.api.shutdown)
+
+    def record_alert(self, subject, body, recipients, priority=None, topic=None):
+        with self.alerts_lock:
+            self.alerts.append(subject)
+
+    def run_probe_loop(self, stop, sweeps, errors):
+        while not stop.is_set():
+            try:
+                primary_watchdog.monitor_iteration()
+                sweeps.append(time.time())
+            except Exception as e:
+                errors.append(e)
+            stop.wait(0.02)
+
+    def wait_for_sweeps(self, sweeps, count, timeout=60):
+        target = len(sweeps) + count
+        deadline = time.time() + timeout
+        while len(sweeps) < target:
+            self.assertLess(time.time(), deadline, "probe loop stopped sweeping")
+            time.sleep(0.01)
+
+    def test_control_api_and_probe_loop_under_load(self):
+        # Arrange: tasks that leave a known final state behind
+        rng = random.Random(42)
+        kept = defaultdict(set)
+        tasks = []
+        for i in range(LOAD_REQUESTS // 4):
+            name = self.names[i % len(self.names)]
+            email = f"keep{i}@example.com"
+            kept[name].add(email)
+            tasks.append(("subscribe", name, email))
+        for i in range(LOAD_REQUESTS // 4):
+            tasks.append(("churn", self.names[rng.randrange(len(self.names))], f"churn{i}@example.com"))
+        tasks.extend(("refresh", None, None) for _ in range(LOAD_REQUESTS - len(tasks) - (LOAD_REQUESTS // 4)))
+        rng.shuffle(tasks)
+
+        latencies = {op: [] for op in ("subscribe", "unsubscribe", "refresh")}
+        failures = []
+        local = threading.local()
+
+        def call(op, payload=None):
+            session = getattr(local, "session", None)
+            if session is None:
+                session = local.session = requests.Session()
+            started = time.perf_counter()
+            response = session.post(f"{self.api_url}/{op}", json=payload, timeout=30)
+            latencies[op].append(time.perf_counter() - started)
+            return response
+
+        def run_task(task):
+            op, name, email = task
+            if op == "refresh":
+                expected = [("refresh", None)]
+            elif op == "subscribe":
+                expected = [("subscribe", {"service_name": name, "gmail_id": email})]
+            else:
+                # Subscribe then unsubscribe the same address; the unsubscribe must see the subscribe
+                expected = [("subscribe", {"service_name": name, "gmail_id": email}),
+                            ("unsubscribe", {"service_name": name, "gmail_id": email})]
+            for endpoint, payload in expected:
+                response = call(endpoint, payload)
+                if response.status_code != 200:
+                    failures.append((endpoint, payload, response.status_code, response.text))
+
+        stop = threading.Event()
+        sweeps = []
+        loop_errors = []
+        with self.fake.lock:
+            self.fake.hits.clear()
+        probe_thread = threading.Thread(target=self.run_probe_loop, args=(stop, sweeps, loop_errors), daemon=True)
+        probe_thread.start()
+
+        # Act: hammer the API while an outage comes and goes underneath the probe loop
+        outage = self.names[:OUTAGE_SERVICES]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=LOAD_CLIENTS) as pool:
+            futures = [pool.submit(run_task, task) for task in tasks]
+            self.wait_for_sweeps(sweeps, 2)
+            self.fake.set_down(outage)
+            self.wait_for_sweeps(sweeps, 2)
+            self.fake.set_down(outage, down=False)
+            self.wait_for_sweeps(sweeps, 2)
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - started
+
+        stop.set()
+        probe_thread.join()
+
+        # Report the baseline
+        total = sum(len(v) for v in latencies.values())
+        print(f"\n{total} requests from {LOAD_CLIENTS} clients in {elapsed:.2f}s "
+              f"({total / elapsed:.0f} req/s), {len(sweeps)} sweeps over {LOAD_SERVICES} services")
+        for op, values in sorted(latencies.items()):
+            print(f"  {op:<12} n={len(values):<6} p50={percentile(values, 50) * 1000:7.1f}ms "
+                  f"p99={percentile(values, 99) * 1000:7.1f}ms")
+
+        # Assert: nothing failed
+        self.assertEqual(loop_errors, [])
+        self.assertEqual(failures[:5], [])
+
+        # Assert: no lost updates, in Mongo or in the primary's in-memory registry
+        client = MongoClient(self.mongo_uri)
+        stored = {doc["name"]: set(doc["recipients"])
+                  for doc in client["Qubit"]["Watchdog_microservices"].find({}, {"name": 1, "recipients": 1})}
+        client.close()
+        services, _ = primary_watchdog.registry_snapshot()
+        in_memory = {service["name"]: set(service["recipients"]) for service in services}
+        for name in self.names:
+            expected = kept[name] | {f"owner@{name}.test"}
+            self.assertEqual(stored[name], expected, f"lost update in Mongo for {name}")
+            self.assertEqual(in_memory[name], expected, f"stale in-memory registry for {name}")
+
+        # Assert: exactly one down and one up alert per outage service, nothing else
+        expected_alerts = Counter()
+        for name in outage:
+            expected_alerts[f"ALERT: {name} is down!"] += 1
+            expected_alerts[f"ALERT: {name} is up!"] += 1
+        self.assertEqual(Counter(self.alerts), expected_alerts)
+
+        # Assert: every completed sweep probed every service exactly once
+        with self.fake.lock:
+            hits = dict(self.fake.hits)
+        for name in self.names:
+            self.assertEqual(hits.get(name, 0), len(sweeps), f"missed or repeated probes for {name}")
+
+        # Assert: a refresh requested after the storm is still honoured
+        self.assertEqual(requests.post(f"{self.api_url}/refresh", timeout=5).status_code, 200)
+        primary_watchdog.monitor_iteration()
+        self.assertFalse(primary_watchdog.refresh_flag)
+
+if __name__ == '__main__':
+    unittest.main()
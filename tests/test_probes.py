@@ -0,0 +1,370 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import probes  # The module we're testing
+
+def make_response(status_code=200, chunks=()):
+    response = MagicMock()
+    response.status_code = status_code
+    response.iter_content.return_value = iter(chunks)
+    return response
+
+class TestProbes(unittest.TestCase):
+    def setUp(self):
+        probes.compile_assertions([])
+
+    @patch('probes.ProbeSession.get')
+    def test_probe_without_expect_skips_body(self, mock_requests_get):
+        # Arrange
+        response = make_response(200, [b"x" * 10])
+        mock_requests_get.return_value = response
+        service = {"name": "service1", "url": "http://example.com/status"}
+
+        # Act
+        healthy, reason = probes.probe_http(service)
+
+        # Assert
+        self.assertTrue(healthy)
+        self.assertIsNone(reason)
+        mock_requests_get.assert_called_with(service['url'], timeout=5, stream=True)
+        response.iter_content.assert_not_called()
+        response.close.assert_called_once()
+
+    @patch('probes.ProbeSession.get')
+    def test_probe_bad_status(self, mock_requests_get):
+        # Arrange
+        mock_requests_get.return_value = make_response(503)
+        service = {"name": "service1", "url": "http://example.com/status"}
+
+        # Act
+        healthy, reason = probes.probe_http(service)
+
+        # Assert
+        self.assertFalse(healthy)
+        self.assertEqual(reason, "returned status code 503")
+
+    @patch('probes.ProbeSession.get')
+    def test_probe_json_field_assertion(self, mock_requests_get):
+        # Arrange
+        service = {"name": "service1", "url": "http://example.com/status",
+                   "expect": {"json_field": "db.state", "equals": "ok"}}
+        probes.compile_assertions([service])
+
+        # Act
+        mock_requests_get.return_value = make_response(200, [b'{"db": {"st', b'ate": "ok"}}'])
+        up = probes.probe_http(service)
+        mock_requests_get.return_value = make_response(200, [b'{"db": {"state": "degraded"}}'])
+        down = probes.probe_http(service)
+
+        # Assert
+        self.assertEqual(up, (True, None))
+        self.assertFalse(down[0])
+        self.assertIn("degraded", down[1])
+
+    @patch('probes.ProbeSession.get')
+    def test_probe_regex_assertion(self, mock_requests_get):
+        # Arrange
+        service = {"name": "service1", "url": "http://example.com/status", "expect": {"regex": "alive"}}
+        probes.compile_assertions([service])
+        mock_requests_get.return_value = make_response(200, [b'{"status": "alive"}'])
+
+        # Act
+        healthy, reason = probes.probe_http(service)
+
+        # Assert
+        self.assertTrue(healthy)
+
+    @patch('probes.ProbeSession.get')
+    def test_probe_body_too_large(self, mock_requests_get):
+        # Arrange
+        service = {"name": "service1", "url": "http://example.com/status", "expect": {"regex": "alive"}}
+        response = make_response(200, [b"a" * 60, b"a" * 60, b"alive"])
+        mock_requests_get.return_value = response
+
+        # Act
+        healthy, reason = probes.probe_http(service, max_bytes=100)
+
+        # Assert
+        self.assertFalse(healthy)
+        self.assertEqual(reason, "response body exceeded 100 bytes")
+        response.close.assert_called_once()
+
+    def test_compile_assertions_caches_and_isolates_bad_specs(self):
+        # Arrange
+        good = {"name": "good", "expect": {"regex": "ok"}}
+        bad = {"name": "bad", "expect": {"regex": "("}}
+
+        # Act
+        probes.compile_assertions([good, bad])
+
+        # Assert
+        self.assertIs(probes.get_assertion(good), probes.get_assertion(good))
+        self.assertEqual(probes.get_assertion(bad)(b"ok")[0], False)
+
+
+class TestProbeDeadline(unittest.TestCase):
+    """Runs probe_http against a real server that trickles its reply a byte at a time"""
+
+    def start_trickler(self, head, body):
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(4)
+        self.addCleanup(server.close)
+        stop = threading.Event()
+        self.addCleanup(stop.set)
+
+        def serve():
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            with conn:
+                conn.recv(1024)
+                try:
+                    conn.sendall(head)
+                    for byte in body:
+                        if stop.wait(0.2):
+                            return
+                        conn.sendall(bytes([byte]))
+                except OSError:
+                    return
+
+        threading.Thread(target=serve, daemon=True).start()
+        return server.getsockname()[1]
+
+    def test_trickling_body_is_cut_off_at_deadline(self):
+        # Arrange: every byte arrives well within the socket timeout
+        port = self.start_trickler(b"HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n", b"x" * 100)
+        service = {"name": "slow", "url": f"http://127.0.0.1:{port}/status", "expect": {"regex": "alive"}}
+        probes.compile_assertions([service])
+
+        # Act
+        started = time.monotonic()
+        healthy, reason = probes.probe_http(service, timeout=5, deadline=1)
+
+        # Assert
+        self.assertFalse(healthy)
+        self.assertEqual(reason, "probe deadline exceeded while reading body")
+        self.assertLess(time.monotonic() - started, 3)
+
+    def test_trickling_headers_are_cut_off_at_deadline(self):
+        # Arrange
+        port = self.start_trickler(b"", b"HTTP/1.1 200 OK\r\n" + b"X-Padding: " + b"x" * 100)
+        service = {"name": "slow", "url": f"http://127.0.0.1:{port}/status"}
+
+        # Act
+        started = time.monotonic()
+        healthy, reason = probes.probe_http(service, timeout=5, deadline=1)
+
+        # Assert
+        self.assertFalse(healthy)
+        self.assertEqual(reason, "probe deadline exceeded while waiting for headers")
+        self.assertLess(time.monotonic() - started, 3)
+
+    def test_fast_reply_within_deadline(self):
+        # Arrange
+        port = self.start_trickler(b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nalive", b"")
+        service = {"name": "fast", "url": f"http://127.0.0.1:{port}/status", "expect": {"regex": "alive"}}
+        probes.compile_assertions([service])
+
+        # Act
+        healthy, reason = probes.probe_http(service, timeout=5, deadline=1)
+
+        # Assert
+        self.assertTrue(healthy)
+        self.assertIsNone(reason)
+
+class TestProbeBatch(unittest.TestCase):
+    """Runs the multiplexer against real sockets on localhost"""
+
+    def start_server(self, reply, tls_context=None):
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(16)
+        self.addCleanup(server.close)
+        held = []
+        self.addCleanup(lambda: [conn.close() for conn in held])
+
+        def serve():
+            while True:
+                try:
+                    conn, _ = server.accept()
+                except OSError:
+                    return
+                if reply is None:
+                    held.append(conn)  # Leave the client waiting
+                    continue
+                try:
+                    if tls_context is not None:
+                        conn = tls_context.wrap_socket(conn, server_side=True)
+                    with conn:
+                        conn.recv(1024)
+                        conn.sendall(reply)
+                except (OSError, ssl.SSLError):
+                    pass
+
+        threading.Thread(target=serve, daemon=True).start()
+        return server.getsockname()[1]
+
+    def closed_port(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def test_tcp_connect(self):
+        # Arrange
+        open_port = self.start_server(None)
+        services = [
+            {"name": "open", "url": f"tcp://127.0.0.1:{open_port}", "probe_type": "tcp_connect"},
+            {"name": "closed", "url": f"tcp://127.0.0.1:{self.closed_port()}", "probe_type": "tcp_connect"},
+        ]
+
+        # Act
+        results = probes.probe_batch(services, timeout=2)
+
+        # Assert
+        self.assertEqual(results["open"], (True, None))
+        self.assertFalse(results["closed"][0])
+
+    def test_http_head(self):
+        # Arrange
+        ok_port = self.start_server(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+        bad_port = self.start_server(b"HTTP/1.1 503 Service Unavailable\r\n\r\n")
+        services = [
+            {"name": "ok", "url": f"http://127.0.0.1:{ok_port}/status", "probe_type": "http_head"},
+            {"name": "bad", "url": f"http://127.0.0.1:{bad_port}/status", "probe_type": "http_head"},
+        ]
+
+        # Act
+        results = probes.probe_batch(services, timeout=2, max_in_flight=1)
+
+        # Assert
+        self.assertEqual(results["ok"], (True, None))
+        self.assertEqual(results["bad"], (False, "returned status code 503"))
+
+    @unittest.skipUnless(shutil.which("openssl"), "needs openssl to make a test certificate")
+    def test_https_head_handshakes_on_the_multiplexer(self):
+        # Arrange: a self-signed certificate for localhost, trusted by the probe
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        cert, key = os.path.join(workdir, "cert.pem"), os.path.join(workdir, "key.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                        "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost",
+                        "-keyout", key, "-out", cert], check=True, capture_output=True)
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(cert, key)
+        client_context = ssl.create_default_context(cafile=cert)
+
+        ok_port = self.start_server(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n", server_context)
+        # Servers that accept but never answer the handshake
+        stalled = [self.start_server(None) for _ in range(3)]
+        services = [{"name": "ok", "url": f"https://localhost:{ok_port}/status", "probe_type": "http_head"}]
+        services += [{"name": f"stalled{i}", "url": f"https://localhost:{port}/status", "probe_type": "http_head"}
+                     for i, port in enumerate(stalled)]
+
+        # Act
+        started = time.monotonic()
+        with patch.object(probes, '_tls_context', client_context):
+            results = probes.probe_batch(services, timeout=1)
+        elapsed = time.monotonic() - started
+
+        # Assert: the stalled handshakes time out together instead of one after another
+        self.assertEqual(results["ok"], (True, None))
+        for i in range(3):
+            self.assertEqual(results[f"stalled{i}"], (False, "timed out after 1s"))
+        self.assertLess(elapsed, 2.5)
+
+    @patch('probes.socket.getaddrinfo')
+    def test_resolved_addresses_expire(self, mock_getaddrinfo):
+        # Arrange
+        probes._dns_cache.clear()
+        self.addCleanup(probes._dns_cache.clear)
+        old = (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("10.0.0.1", 80))
+        new = (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("10.0.0.2", 80))
+        mock_getaddrinfo.side_effect = [[old], [new]]
+
+        # Act
+        first = probes._resolve("svc.internal", 80, now=0)
+        cached = probes._resolve("svc.internal", 80, now=probes.PROBE_DNS_TTL - 1)
+        moved = probes._resolve("svc.internal", 80, now=probes.PROBE_DNS_TTL + 1)
+        probes._prune_dns_cache(2 * probes.PROBE_DNS_TTL + 2)
+
+        # Assert
+        self.assertEqual(first[1], ("10.0.0.1", 80))
+        self.assertEqual(cached[1], ("10.0.0.1", 80))
+        self.assertEqual(moved[1], ("10.0.0.2", 80))
+        self.assertEqual(mock_getaddrinfo.call_count, 2)
+        self.assertEqual(probes._dns_cache, {})
+
+    def test_malformed_hostname_only_fails_its_own_target(self):
+        # Arrange
+        open_port = self.start_server(None)
+        services = [
+            {"name": "bad", "url": "tcp://a..b:80", "probe_type": "tcp_connect"},
+            {"name": "open", "url": f"tcp://127.0.0.1:{open_port}", "probe_type": "tcp_connect"},
+        ]
+
+        # Act
+        results = probes.probe_batch(services, timeout=2)
+
+        # Assert
+        self.assertFalse(results["bad"][0])
+        self.assertTrue(results["bad"][1].startswith("connect failed: "))
+        self.assertEqual(results["open"], (True, None))
+
+    def test_unsupported_probe_type(self):
+        # Act
+        results = probes.probe_batch([{"name": "odd", "url": "http://127.0.0.1/", "probe_type": "ping"}])
+
+        # Assert
+        self.assertEqual(results["odd"], (False, "unsupported probe_type ping"))
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_claims_share_one_probe(self):
+        # Arrange
+        flight = probes.SingleFlight()
+        service = {"name": "service1", "url": "http://example.com/status"}
+
+        # Act
+        first, owned_first = flight.claim([service])
+        second, owned_second = flight.claim([service])
+        flight.resolve("service1", (True, None))
+        third, owned_third = flight.claim([service])
+
+        # Assert
+        self.assertEqual(owned_first, [service])
+        self.assertEqual(owned_second, [])
+        self.assertIs(first["service1"], second["service1"])
+        self.assertEqual(second["service1"].result(timeout=1), (True, None))
+        self.assertEqual(owned_third, [service])  # Finished probes are not reused
+        self.assertEqual(flight.get_stats(), {"probes": 2, "coalesced": 1, "in_flight": 1})
+
+    def test_errors_reach_every_waiter(self):
+        # Arrange
+        flight = probes.SingleFlight()
+        service = {"name": "service1", "url": "http://example.com/status"}
+        first, _ = flight.claim([service])
+        second, _ = flight.claim([service])
+
+        # Act
+        flight.resolve("service1", error=RuntimeError("boom"))
+
+        # Assert
+        for futures in (first, second):
+            with self.assertRaises(RuntimeError):
+                futures["service1"].result(timeout=1)
+
+if __name__ == '__main__':
+    unittest.main()
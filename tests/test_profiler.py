@@ -0,0 +1,87 @@
+import unittest
+from unittest.mock import patch
+import os
+import sys
+import threading
+import time
+from flask import Flask
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import profiler  # The module we're testing
+
+def busy_worker(stop):
+    while not stop.is_set():
+        time.sleep(0.001)
+
+class TestProfilerEndpoints(unittest.TestCase):
+    def setUp(self):
+        app = Flask(__name__)
+        app.register_blueprint(profiler.debug_blueprint)
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.headers = {"Authorization": "Bearer secret"}
+
+    def test_disabled_by_default(self):
+        # Act
+        with patch.object(profiler, 'DEBUG_TOKEN', "secret"):
+            response = self.client.get('/debug/threads', headers=self.headers)
+
+        # Assert
+        self.assertEqual(response.status_code, 404)
+
+    @patch.object(profiler, 'DEBUG_ENDPOINTS_ENABLED', True)
+    @patch.object(profiler, 'DEBUG_TOKEN', "secret")
+    def test_requires_token(self):
+        # Act
+        missing = self.client.get('/debug/threads')
+        wrong = self.client.get('/debug/threads', headers={"X-Debug-Token": "guess"})
+
+        # Assert
+        self.assertEqual(missing.status_code, 401)
+        self.assertEqual(wrong.status_code, 401)
+
+    @patch.object(profiler, 'DEBUG_ENDPOINTS_ENABLED', True)
+    @patch.object(profiler, 'DEBUG_TOKEN', "secret")
+    def test_threads_dump(self):
+        # Act
+        response = self.client.get('/debug/threads', headers=self.headers)
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Thread MainThread", response.get_data(as_text=True))
+
+    @patch.object(profiler, 'DEBUG_ENDPOINTS_ENABLED', True)
+    @patch.object(profiler, 'DEBUG_TOKEN', "secret")
+    def test_profile_returns_collapsed_stacks(self):
+        # Arrange
+        stop = threading.Event()
+        worker = threading.Thread(target=busy_worker, args=(stop,), name="probe-loop", daemon=True)
+        worker.start()
+
+        # Act
+        try:
+            response = self.client.get('/debug/profile?seconds=0.2', headers=self.headers)
+        finally:
+            stop.set()
+            worker.join()
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        lines = response.get_data(as_text=True).strip().splitlines()
+        worker_lines = [line for line in lines if line.startswith("probe-loop;")]
+        self.assertTrue(worker_lines)
+        self.assertIn("busy_worker (test_profiler.py:", worker_lines[0])
+        self.assertTrue(all(line.rsplit(" ", 1)[1].isdigit() for line in lines))
+        self.assertLessEqual(int(response.headers["X-Profile-Samples"]), 21)
+
+    @patch.object(profiler, 'DEBUG_ENDPOINTS_ENABLED', True)
+    @patch.object(profiler, 'DEBUG_TOKEN', "secret")
+    def test_profile_window_is_bounded(self):
+        # Act
+        response = self.client.get(f'/debug/profile?seconds={profiler.PROFILE_MAX_SECONDS + 1}', headers=self.headers)
+
+        # Assert
+        self.assertEqual(response.status_code, 400)
+
+if __name__ == '__main__':
+    unittest.main()
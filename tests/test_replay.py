@@ -0,0 +1,90 @@
+import unittest
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import replay  # The module we're testing
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.registry = [
+            {"name": "data_collection", "url": "http://localhost:5001/status",
+             "recipients": ["a@corp.com", "b@corp.com"], "prev_status": True},
+            {"name": "data_retrival", "url": "http://localhost:5002/status",
+             "recipients": ["c@corp.com", "x@other.org"], "prev_status": True, "depends_on": ["data_collection"]},
+        ]
+
+    def test_outage_produces_one_alert_per_transition(self):
+        # Arrange
+        events = replay.scenario_events("outage:data_collection:3600:1800")
+
+        # Act
+        report = replay.simulate(self.registry, events, interval=300, horizon=4 * 3600)
+
+        # Assert
+        alerts = [(a["t"], a["service"], a["type"], a["root_cause"]) for a in report["alerts"]]
+        self.assertEqual(alerts, [
+            (3600, "data_collection", "down", False),
+            (3600, "data_collection", "down", True),
+            (5400, "data_collection", "up", False),
+            (5400, "data_collection", "up", True),
+        ])
+        self.assertEqual(report["sweeps"], 49)
+        self.assertEqual(report["status_writes"], 2)
+        # Each alert goes out as one transaction per recipient domain
+        self.assertEqual(report["smtp_transactions"], 6)
+        self.assertEqual(report["smtp_recipients"], 8)
+        # Delivered at the virtual time of each transition, with nothing throttled
+        self.assertEqual([d["t"] for d in report["deliveries"]], [3600.0] * 3 + [5400.0] * 3)
+        self.assertEqual(report["virtual_seconds"], 4 * 3600)
+        self.assertEqual(report["throttled"], 0)
+
+    def test_longer_interval_misses_short_flaps(self):
+        # Arrange
+        events = replay.scenario_events("flap:data_collection:30:600:60")
+
+        # Act
+        fast = replay.simulate(self.registry, events, interval=60, horizon=1200)
+        slow = replay.simulate(self.registry, events, interval=600, horizon=1200)
+
+        # Assert
+        self.assertEqual(len([a for a in fast["alerts"] if not a["root_cause"]]), 10)
+        self.assertEqual(len([a for a in slow["alerts"] if not a["root_cause"]]), 0)
+
+    def test_timeout_applies_to_recorded_latency(self):
+        # Arrange
+        timeline = replay.Timeline([{"t": 0, "service": "s", "healthy": True, "latency": 3.0, "reason": None}])
+
+        # Act / Assert
+        self.assertEqual(timeline.outcome_at("s", 10, timeout=5), (True, None))
+        self.assertEqual(timeline.outcome_at("s", 10, timeout=2), (False, "timed out after 2s"))
+
+    def test_load_jsonl_with_timestamps(self):
+        # Arrange
+        rows = [{"t": "2025-03-01T10:00:00", "service": "s", "healthy": True},
+                {"t": "2025-03-01T10:05:00", "service": "s", "healthy": False, "reason": "503"}]
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as f:
+            f.write("\n".join(json.dumps(row) for row in rows))
+        self.addCleanup(os.remove, f.name)
+
+        # Act
+        events = replay.load_jsonl(f.name)
+
+        # Assert
+        self.assertEqual([e["t"] for e in events], [0.0, 300.0])
+        self.assertEqual(events[1]["reason"], "503")
+
+    def test_log_line_pattern(self):
+        # Act
+        match = replay.LOG_LINE.search("2025-03-01 10:00:00,000 - MongoLogger - INFO - data_collection is down.")
+        suppressed = replay.LOG_LINE.search("... - INFO - data_retrival is down while data_collection is down.")
+
+        # Assert
+        self.assertEqual(match.group("name"), "data_collection")
+        self.assertEqual(match.group("state"), "down")
+        self.assertIsNone(suppressed)
+
+if __name__ == '__main__':
+    unittest.main()
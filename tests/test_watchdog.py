@@ -3,6 +3,8 @@ from unittest.mock import patch, MagicMock, call
 import json
 import os
 import sys
+import threading
+import time
 from pymongo import MongoClient
 import requests
 
@@ -64,7 +66,7 @@ class TestPrimaryWatchdog(unittest.TestCase):
         self.assertEqual(data['message'], 'Primary Watchdog is running.')
 
     @patch('primary_watchdog.send_email')
-    @patch('primary_watchdog.requests.get')
+    @patch('probes.ProbeSession.get')
     def test_check_service_health_up(self, mock_requests_get, mock_send_email):
         # Arrange
         mock_response = MagicMock()
@@ -79,12 +81,12 @@ class TestPrimaryWatchdog(unittest.TestCase):
         
         # Assert
         self.assertTrue(result)
-        mock_requests_get.assert_called_with(service['url'], timeout=5)
+        mock_requests_get.assert_called_with(service['url'], timeout=5, stream=True)
         mock_update.assert_called_with(service['name'], True)
         mock_send_email.assert_called_once()  # Should send "up" alert
 
     @patch('primary_watchdog.send_email')
-    @patch('primary_watchdog.requests.get')
+    @patch('probes.ProbeSession.get')
     def test_check_service_health_down(self, mock_requests_get, mock_send_email):
         # Arrange
         mock_response = MagicMock()
@@ -99,12 +101,12 @@ class TestPrimaryWatchdog(unittest.TestCase):
         
         # Assert
         self.assertFalse(result)
-        mock_requests_get.assert_called_with(service['url'], timeout=5)
+        mock_requests_get.assert_called_with(service['url'], timeout=5, stream=True)
         mock_update.assert_called_with(service['name'], False)
         mock_send_email.assert_called_once()  # Should send "down" alert
 
     @patch('primary_watchdog.send_email')
-    @patch('primary_watchdog.requests.get')
+    @patch('probes.ProbeSession.get')
     def test_check_service_health_exception(self, mock_requests_get, mock_send_email):
         # Arrange
         mock_requests_get.side_effect = requests.exceptions.RequestException("Connection error")
@@ -117,10 +119,266 @@ class TestPrimaryWatchdog(unittest.TestCase):
         
         # Assert
         self.assertFalse(result)
-        mock_requests_get.assert_called_with(service['url'], timeout=5)
+        mock_requests_get.assert_called_with(service['url'], timeout=5, stream=True)
         mock_update.assert_called_with(service['name'], False)
         mock_send_email.assert_called_once()  # Should send "down" alert
 
+    @patch('primary_watchdog.send_email')
+    @patch('primary_watchdog.update_prev_status')
+    def test_record_probe_result_no_change(self, mock_update, mock_send_email):
+        # Arrange
+        service = self.test_services[0].copy()  # Service was previously up
+
+        # Act
+        result = primary_watchdog.record_probe_result(service, True)
+
+        # Assert
+        self.assertTrue(result)
+        mock_update.assert_not_called()  # Nothing to persist without a transition
+        mock_send_email.assert_not_called()
+
+    @patch('primary_watchdog.record_probe_result')
+    @patch('primary_watchdog.probe_batch')
+    @patch('primary_watchdog.check_service_health')
+    def test_run_sweep_batches_cheap_probes(self, mock_check_health, mock_probe_batch, mock_record):
+        # Arrange
+        http_service = self.test_services[0].copy()
+        tcp_service = dict(self.test_services[1], probe_type="tcp_connect")
+        mock_probe_batch.return_value = {"service2": (False, "connect failed: Connection refused")}
+
+        # Act
+        primary_watchdog.run_sweep([http_service, tcp_service])
+
+        # Assert
+        graph = primary_watchdog.dependency_graph
+        mock_check_health.assert_called_once_with(http_service, graph)
+        mock_probe_batch.assert_called_once_with([tcp_service])
+        mock_record.assert_called_once_with(tcp_service, False, "connect failed: Connection refused", graph=graph)
+
+    @patch('primary_watchdog.probe_batch')
+    @patch('primary_watchdog.probe_http')
+    def test_probe_cache_skips_recently_probed_services(self, mock_probe_http, mock_probe_batch):
+        # Arrange
+        cache = MagicMock()
+        cache.get.return_value = (False, "returned status code 503")
+        cache.get_many.return_value = {"service2": (True, None)}
+        http_service = self.test_services[0].copy()
+        tcp_services = [dict(self.test_services[1], probe_type="tcp_connect"),
+                        {"name": "service3", "url": "tcp://example.com:6379", "recipients": [],
+                         "prev_status": True, "probe_type": "tcp_connect"}]
+        mock_probe_batch.return_value = {"service3": (False, "connect failed: Connection refused")}
+
+        with patch.object(primary_watchdog, 'probe_cache', cache):
+            # Act
+            single = primary_watchdog.probe_service(http_service)
+            batch = primary_watchdog.probe_services_batch(tcp_services)
+
+        # Assert: only the service without a fresh result is probed, and its result is shared
+        self.assertEqual(single, (False, "returned status code 503"))
+        mock_probe_http.assert_not_called()
+        mock_probe_batch.assert_called_once_with([tcp_services[1]])
+        cache.put_many.assert_called_once_with([(tcp_services[1], False, "connect failed: Connection refused")])
+        self.assertEqual(batch, {"service2": (True, None), "service3": (False, "connect failed: Connection refused")})
+
+    @patch('primary_watchdog.send_email')
+    @patch('primary_watchdog.update_prev_status')
+    @patch('primary_watchdog.probe_http')
+    def test_run_sweep_suppresses_dependents_of_down_service(self, mock_probe_http, mock_update, mock_send_email):
+        # Arrange
+        services = [
+            {"name": "root", "url": "http://example.com/root", "recipients": ["ops@example.com"], "prev_status": True},
+            {"name": "child", "url": "http://example.com/child", "recipients": ["dev@example.com"],
+             "prev_status": True, "depends_on": ["root"]},
+        ]
+        root_up = {"value": False}
+        mock_probe_http.side_effect = lambda s: (root_up["value"], None if root_up["value"] else "returned status code 503")
+
+        with patch.object(primary_watchdog, 'dependency_graph', primary_watchdog.DependencyGraph(services)), \
+                patch.object(primary_watchdog, 'suppressed_sweeps', {}), \
+                patch.object(primary_watchdog, 'SUPPRESSED_PROBE_EVERY', 100):
+            # Act: the root goes down
+            primary_watchdog.run_sweep(services)
+
+            # Assert: only the root is probed, the child gets one root cause alert
+            self.assertEqual([c.args[0]['name'] for c in mock_probe_http.call_args_list], ["root"])
+            self.assertEqual([c.args[2] for c in mock_send_email.call_args_list],
+                             [["ops@example.com"], ["dev@example.com"]])
+            self.assertTrue(services[1]["prev_status"])
+
+            # Act: the root recovers, the child is re-probed in the same pass
+            mock_probe_http.reset_mock()
+            mock_send_email.reset_mock()
+            root_up["value"] = True
+            primary_watchdog.run_sweep(services)
+
+            # Assert
+            self.assertEqual([c.args[0]['name'] for c in mock_probe_http.call_args_list], ["root", "child"])
+            self.assertIn("root is up", mock_send_email.call_args_list[1].args[0])
+
+    @patch('primary_watchdog.send_email')
+    @patch('primary_watchdog.update_prev_status')
+    @patch('primary_watchdog.probe_batch')
+    @patch('primary_watchdog.probe_http')
+    def test_run_sweep_root_cause_alerts_use_the_sweep_graph(self, mock_probe_http, mock_probe_batch,
+                                                             mock_update, mock_send_email):
+        # Arrange: a reload replaced the global graph after the sweep took its snapshot
+        services = [
+            {"name": "root", "url": "http://example.com/root", "recipients": ["ops@example.com"], "prev_status": True},
+            {"name": "cache", "url": "tcp://example.com:6379", "recipients": ["ops@example.com"],
+             "prev_status": True, "probe_type": "tcp_connect"},
+            {"name": "child", "url": "http://example.com/child", "recipients": ["dev@example.com"],
+             "prev_status": True, "depends_on": ["root", "cache"]},
+        ]
+        snapshot = primary_watchdog.DependencyGraph(services)
+        reloaded = primary_watchdog.DependencyGraph([dict(s, depends_on=[]) for s in services])
+        mock_probe_http.return_value = (False, "returned status code 503")
+        mock_probe_batch.return_value = {"cache": (False, "connect failed: Connection refused")}
+
+        with patch.object(primary_watchdog, 'dependency_graph', reloaded), \
+                patch.object(primary_watchdog, 'suppressed_sweeps', {}), \
+                patch.object(primary_watchdog, 'SUPPRESSED_PROBE_EVERY', 100):
+            # Act
+            primary_watchdog.run_sweep(services, snapshot)
+
+        # Assert: both the batched and the single probe alert the dependent in the snapshot
+        recipients = [c.args[2] for c in mock_send_email.call_args_list]
+        self.assertEqual(recipients.count(["dev@example.com"]), 2)
+
+    @patch('primary_watchdog.send_email')
+    @patch('primary_watchdog.update_prev_status')
+    @patch('primary_watchdog.probe_http')
+    def test_check_recording_during_sweep_probe_alerts_once(self, mock_probe_http, mock_update, mock_send_email):
+        # Arrange
+        services = [
+            {"name": "root", "url": "http://example.com/root", "recipients": ["ops@example.com"], "prev_status": True},
+            {"name": "child", "url": "http://example.com/child", "recipients": ["dev@example.com"],
+             "prev_status": True, "depends_on": ["root"]},
+        ]
+        graph = primary_watchdog.DependencyGraph(services)
+
+        def probe_while_check_records(service):
+            if service['name'] == "root":
+                # A /check of the root records the outage while the sweep's probe is in flight
+                primary_watchdog.record_check_result(service, False, "returned status code 503", graph)
+            return False, "returned status code 503"
+        mock_probe_http.side_effect = probe_while_check_records
+
+        with patch.object(primary_watchdog, 'dependency_graph', graph), \
+                patch.object(primary_watchdog, 'suppressed_sweeps', {}):
+            # Act
+            primary_watchdog.run_sweep(services, graph)
+
+        # Assert: one down alert and one root cause alert, not two of each
+        subjects = [c.args[0] for c in mock_send_email.call_args_list]
+        self.assertEqual(subjects, ["ALERT: root is down!",
+                                    "ALERT: root is down, affecting 1 dependent services!"])
+        mock_update.assert_called_once_with("root", False)
+
+    @patch('primary_watchdog.send_email')
+    @patch('primary_watchdog.update_prev_status')
+    @patch('primary_watchdog.probe_http')
+    def test_check_of_recovered_service_rechecks_its_subtree(self, mock_probe_http, mock_update, mock_send_email):
+        # Arrange: the root was down and the child has been sitting out sweeps since
+        services = [
+            {"name": "root", "url": "http://example.com/root", "recipients": ["ops@example.com"], "prev_status": False},
+            {"name": "child", "url": "http://example.com/child", "recipients": ["dev@example.com"],
+             "prev_status": True, "depends_on": ["root"]},
+        ]
+        child_probed = threading.Event()
+
+        def probe(service):
+            if service['name'] == "child":
+                child_probed.set()
+                return False, "returned status code 500"
+            return True, None
+        mock_probe_http.side_effect = probe
+
+        with patch.object(primary_watchdog, 'microservices', services), \
+                patch.object(primary_watchdog, 'dependency_graph', primary_watchdog.DependencyGraph(services)):
+            # Act
+            response = self.client.post('/check', json={"services": ["root"]})
+            child_probed.wait(5)
+            deadline = time.time() + 5
+            while primary_watchdog.check_flight.get_stats()["in_flight"] and time.time() < deadline:
+                time.sleep(0.01)
+
+        # Assert: the "re-checking now" alert is backed by an actual probe of the child
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(child_probed.is_set())
+        subjects = [c.args[0] for c in mock_send_email.call_args_list]
+        self.assertIn("ALERT: root is up, re-checking 1 dependent services!", subjects)
+        self.assertIn("ALERT: child is down!", subjects)
+        self.assertFalse(services[1]["prev_status"])
+
+    @patch('primary_watchdog.send_email')
+    @patch('primary_watchdog.update_prev_status')
+    @patch('primary_watchdog.probe_http')
+    def test_check_endpoint_coalesces_and_alerts(self, mock_probe_http, mock_update, mock_send_email):
+        # Arrange: a probe that stays in flight until released
+        services = [dict(s) for s in self.test_services]
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_probe(service):
+            started.set()
+            release.wait(5)
+            return False, "returned status code 503"
+        mock_probe_http.side_effect = slow_probe
+
+        with patch.object(primary_watchdog, 'microservices', services), \
+                patch.object(primary_watchdog, 'dependency_graph', primary_watchdog.DependencyGraph(services)):
+            # Act: two deploy hooks ask for service1 at the same time
+            responses = []
+            hooks = [threading.Thread(target=lambda: responses.append(
+                self.client.post('/check', json={"services": ["service1"]}))) for _ in range(2)]
+            coalesced = primary_watchdog.check_flight.get_stats()["coalesced"]
+            hooks[0].start()
+            started.wait(5)
+            hooks[1].start()
+            deadline = time.time() + 5
+            while primary_watchdog.check_flight.get_stats()["coalesced"] == coalesced and time.time() < deadline:
+                time.sleep(0.01)
+            release.set()
+            for hook in hooks:
+                hook.join(5)
+
+        # Assert: one probe, one alert, both hooks get the result
+        mock_probe_http.assert_called_once()
+        mock_update.assert_called_once_with("service1", False)
+        mock_send_email.assert_called_once()
+        for response in responses:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data)["results"],
+                             [{"name": "service1", "healthy": False,
+                               "reason": "returned status code 503", "blocked_by": []}])
+
+    @patch('primary_watchdog.probe_http')
+    def test_check_endpoint_streams_all_services(self, mock_probe_http):
+        # Arrange
+        services = [dict(s) for s in self.test_services]
+        mock_probe_http.side_effect = lambda s: (s['name'] == "service1", None)
+
+        with patch.object(primary_watchdog, 'microservices', services), \
+                patch.object(primary_watchdog, 'dependency_graph', primary_watchdog.DependencyGraph(services)), \
+                patch('primary_watchdog.record_probe_result'):
+            # Act
+            response = self.client.post('/check', json={"services": "all", "stream": True})
+            lines = [json.loads(line) for line in response.data.decode().splitlines()]
+
+        # Assert
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        self.assertEqual({line["name"]: line["healthy"] for line in lines}, {"service1": True, "service2": False})
+
+    def test_check_endpoint_rejects_bad_requests(self):
+        # Act
+        unknown = self.client.post('/check', json={"services": ["nope"]})
+        malformed = self.client.post('/check', json={"services": "service1"})
+
+        # Assert
+        self.assertEqual(unknown.status_code, 404)
+        self.assertEqual(json.loads(unknown.data)["services"], ["nope"])
+        self.assertEqual(malformed.status_code, 400)
+
     @patch('primary_watchdog.get_all_microservices')
     @patch('primary_watchdog.update_recipients')
     def test_subscribe_endpoint_new_subscription(self, mock_update, mock_get_all):
@@ -237,7 +495,9 @@ class TestPrimaryWatchdog(unittest.TestCase):
         mock_send_email.assert_called_with(
             "ALERT: service1 is down!",
             "The microservice service1 is down. Please check the service.",
-            ["test1@example.com"]
+            ["test1@example.com"],
+            priority=primary_watchdog.PRIORITY_DOWN,
+            topic="service1"
         )
 
     @patch('primary_watchdog.send_email')
@@ -249,7 +509,9 @@ class TestPrimaryWatchdog(unittest.TestCase):
         mock_send_email.assert_called_with(
             "ALERT: service1 is up!",
             "The microservice service1 is up. Please check the service.",
-            ["test1@example.com"]
+            ["test1@example.com"],
+            priority=primary_watchdog.PRIORITY_UP,
+            topic="service1"
         )
 
     @patch('primary_watchdog.check_service_health')
@@ -279,9 +541,48 @@ class TestPrimaryWatchdog(unittest.TestCase):
         self.assertFalse(primary_watchdog.refresh_flag)
         
         # Should have called check_service_health for each service
-        expected_calls = [call(service) for service in self.test_services]
+        expected_calls = [call(service, primary_watchdog.dependency_graph) for service in self.test_services]
         mock_check_health.assert_has_calls(expected_calls)
         
+    @patch('primary_watchdog.time.sleep')
+    @patch('primary_watchdog.monitor_services')
+    def test_supervise_monitor_restarts_with_backoff(self, mock_monitor, mock_sleep):
+        # Arrange
+        class StopSupervisor(BaseException):
+            pass
+        mock_monitor.side_effect = Exception("Mongo hiccup")
+        mock_sleep.side_effect = [None, None, StopSupervisor()]
+        restarts = primary_watchdog.monitor_state["restarts"]
+
+        # Act
+        with patch.object(primary_watchdog, 'RESTART_BACKOFF_MIN', 1), \
+                patch.object(primary_watchdog, 'RESTART_BACKOFF_MAX', 60):
+            with self.assertRaises(StopSupervisor):
+                primary_watchdog.supervise_monitor()
+
+        # Assert
+        self.assertEqual(mock_monitor.call_count, 3)
+        self.assertEqual([c.args[0] for c in mock_sleep.call_args_list], [1, 2, 4])
+        self.assertEqual(primary_watchdog.monitor_state["restarts"], restarts + 3)
+        self.assertEqual(primary_watchdog.monitor_state["last_error"], "Exception: Mongo hiccup")
+
+    def test_status_endpoint_reports_stalled_sweep(self):
+        # Arrange
+        now = primary_watchdog.time.time()
+        stalled_state = dict(primary_watchdog.monitor_state,
+                             sweep_started=now - primary_watchdog.SWEEP_DEADLINE - 5,
+                             last_success=now - primary_watchdog.SWEEP_DEADLINE - 5)
+
+        # Act
+        with patch.dict(primary_watchdog.monitor_state, stalled_state):
+            response = self.client.get('/status')
+        data = json.loads(response.data)
+
+        # Assert
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(data['status'], 'unhealthy')
+        self.assertTrue(data['monitor']['stalled'])
+
     @patch('primary_watchdog.threading.Thread')
     def test_main(self, mock_thread):
         # Arrange
@@ -385,7 +686,7 @@ class TestPrimaryWatchdogIntegration(unittest.TestCase):
         self.assertNotIn("test1@example.com", service["recipients"])
 
     @patch('primary_watchdog.send_email')
-    @patch('primary_watchdog.requests.get')
+    @patch('probes.ProbeSession.get')
     def test_check_service_health_integration(self, mock_requests_get, mock_send_email):
         # Arrange
         mock_response = MagicMock()